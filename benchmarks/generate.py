@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Generates synthetic Postbank bank statements for benchmarks.
+
+The csv files look like the Postbank export: some head lines up to the trigger line
+"gebuchte Umsätze", the header and the bookings (newest first) with German dates and
+amounts. The files cover overlapping periods, like statements downloaded every few months.
+Next to the csv files an accounts mapping (sender -> account) and afa files are written.
+"""
+
+import click
+import random
+
+from datetime import date, timedelta
+from pathlib import Path
+
+HEADER = [
+    "Buchungstag", "Wert", "Umsatzart", "Buchungsdetails", "Auftraggeber", "Empfänger",
+    "Betrag", "Saldo"
+]
+TYPES = ("Gutschrift", "SEPA Überweisung", "Lastschrift", "Kartenzahlung")
+ENCODING = "iso-8859-1"
+# The export contains the euro sign in cp1252, which is a control character in iso-8859-1
+# and is removed by 01_clean.
+EURO = "\x80"
+ACCOUNTS_NAME = "accounts_2020-01-01T00:00:00.yml"
+
+
+def format_amount(cents):
+    """Formats cents like the export: -1.234,56 €"""
+    euros, rest = divmod(abs(cents), 100)
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{euros:,}".replace(",", ".") + f",{rest:02d} {EURO}"
+
+
+def generate_bookings(rows, customers, start, seed):
+    """Returns rows bookings in date order with a running balance."""
+    rng = random.Random(seed)
+    balance = 1000000
+    day = start
+    bookings = []
+    per_day = max(1, rows // 3000)
+    for i in range(rows):
+        if i % per_day == 0:
+            day += timedelta(days=rng.randint(0, 2))
+        customer = rng.randint(1, customers)
+        if rng.random() < 0.7:
+            amount = rng.randint(100, 500000)
+            sender, receiver = f"Kunde {customer}", "Wir GmbH"
+        else:
+            amount = -rng.randint(100, 200000)
+            sender, receiver = "Wir GmbH", f"Lieferant {customer}"
+        balance += amount
+        bookings.append([
+            day.strftime("%d.%m.%Y"),
+            (day + timedelta(days=rng.randint(0, 1))).strftime("%d.%m.%Y"),
+            rng.choice(TYPES),
+            f"Referenz NOTPROVIDED Verwendungszweck RE {i:08d} Kunde {customer}",
+            sender,
+            receiver,
+            format_amount(amount),
+            format_amount(balance)
+        ])
+    return bookings
+
+
+def write_csv(filepath, bookings):
+    with open(filepath, "w", encoding=ENCODING) as csv_file:
+        csv_file.write("Umsätze Girokonto;Zeitraum: alle\n")
+        csv_file.write("Kontonummer;1234567890\n\n")
+        csv_file.write("gebuchte Umsätze;\n")
+        csv_file.write(";".join(HEADER) + "\n")
+        for booking in reversed(bookings):
+            csv_file.write(";".join(booking) + "\n")
+
+
+def write_afa(afa_path, assets, seed):
+    rng = random.Random(seed)
+    afa_path.mkdir(exist_ok=True)
+    for i in range(assets):
+        purchase = date(rng.randint(2010, 2024), rng.randint(1, 12), rng.randint(1, 28))
+        with open(afa_path / f"asset_{i:05d}.yaml", "w") as afa_file:
+            afa_file.write(
+                f"name: asset_{i}\n"
+                f"description: Asset number {i}\n"
+                f"date_of_purchase: {purchase.isoformat()}\n"
+                f"price: {rng.randint(10000, 5000000) / 100}\n"
+                f"estimated_lifetime_years: {rng.randint(1, 13)}\n"
+            )
+
+
+def generate(out_path, rows, customers=100, files=4, overlap=0.2, assets=100, seed=1):
+    """
+    Writes rows bookings split into files overlapping csv files, the accounts mapping and
+    afa files to out_path. Returns the paths of the csv files.
+    """
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    bookings = generate_bookings(rows, customers, date(2015, 1, 1), seed)
+    # Extend each chunk into the previous one. The chunks start at a new day, so days in
+    # the overlap are complete in both files.
+    chunk = -(-len(bookings) // files)
+    csv_paths = []
+    for n in range(files):
+        first = max(0, n * chunk - int(chunk * overlap))
+        while 0 < first and bookings[first][0] == bookings[first - 1][0]:
+            first -= 1
+        last = (n + 1) * chunk
+        while last < len(bookings) and bookings[last][0] == bookings[last - 1][0]:
+            last += 1
+        csv_path = out_path / f"postbank_{n:02d}.csv"
+        write_csv(csv_path, bookings[first:last])
+        csv_paths.append(csv_path)
+
+    accounts_path = out_path / "accounts"
+    accounts_path.mkdir(exist_ok=True)
+    with open(accounts_path / ACCOUNTS_NAME, "w") as accounts_file:
+        for customer in range(1, customers + 1):
+            accounts_file.write(f"Kunde {customer}: cust_{customer}\n")
+    write_afa(out_path / "afa", assets, seed)
+    return csv_paths
+
+
+@click.command()
+@click.option("-n", "--rows", default=10000, help="Number of bookings")
+@click.option("-c", "--customers", default=100)
+@click.option("-f", "--files", default=4, help="Number of csv files")
+@click.option("-o", "--overlap", default=0.2, help="Part of each file also in the previous file")
+@click.option("-a", "--assets", default=100, help="Number of afa files")
+@click.option("--seed", default=1)
+@click.argument("out_dir")
+def main(rows, customers, files, overlap, assets, seed, out_dir):
+    for csv_path in generate(out_dir, rows, customers, files, overlap, assets, seed):
+        print(csv_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Runs all stages on synthetic data (see generate.py) and measures wall time, cpu time and
+peak memory (max RSS) of each stage. Each stage runs in its own process, like from the
+command line, so the memory of one stage does not hide the memory of the next one.
+"""
+
+import click
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate import ACCOUNTS_NAME, generate
+from pathlib import Path
+
+# Run the stages from the repository, not from an installed version
+ROOT = Path(__file__).resolve().parent.parent
+SIZES = (10000, 100000, 1000000)
+HEADER = "date_1:date_2:type:details:sender:receiver:amount:balance"
+TRIGGER = "0:gebuchte Umsätze:2"
+
+
+def get_stages(data_path, out_path, csv_paths, fmt, jobs):
+    """Returns (name, arguments) of all stages."""
+    out = str(out_path)
+    fmt_args = ["--output-format", fmt]
+    return [
+        ("csv_to_yml", [
+            "stoier.csvtoyaml", *fmt_args, "-j", str(jobs), out, "-t", TRIGGER, "-h", HEADER,
+            "-r", *map(str, csv_paths)
+        ]),
+        ("clean", ["stoier.clean", *fmt_args, out, f"{out}/01_bookings"]),
+        ("deduplicate", ["stoier.deduplicate", *fmt_args, out, f"{out}/02_clean_bookings"]),
+        ("validate", [
+            "stoier.validate", *fmt_args, out, f"{out}/03_unique_bookings",
+            "--accounts", str(data_path / "accounts" / ACCOUNTS_NAME)
+        ]),
+        ("account", [
+            "stoier.account", *fmt_args, "-j", str(jobs), out, f"{out}/03_unique_bookings",
+            f"{out}/04_valid_bookings"
+        ]),
+        ("report", [
+            "stoier.report", "-j", str(jobs), out, f"{out}/03_unique_bookings",
+            f"{out}/05_accounts"
+        ]),
+        ("afa", ["stoier.afa", "--schedule", str(data_path / "afa")]),
+    ]
+
+
+def run_stage(args, log_file):
+    """Runs python -m args and returns exit status, wall time, cpu time and max RSS (MiB)."""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", *args], stdout=log_file, stderr=subprocess.STDOUT, cwd=ROOT
+    )
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    # Popen.returncode is not set if the process is reaped by os.wait4
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        "status": process.returncode,
+        "wall": round(wall, 3),
+        "cpu": round(rusage.ru_utime + rusage.ru_stime, 3),
+        "max_rss_mib": round(rusage.ru_maxrss / 1024, 1)  # ru_maxrss is in KiB on Linux
+    }
+
+
+def run_size(rows, work_path, fmt, jobs, customers, files):
+    data_path = work_path / f"data_{rows}"
+    out_path = work_path / f"out_{rows}"
+    csv_paths = generate(data_path, rows, customers, files)
+    results = []
+    with open(work_path / f"log_{rows}.txt", "w") as log_file:
+        for name, args in get_stages(data_path, out_path, csv_paths, fmt, jobs):
+            log_file.write(f"# {' '.join(args)}\n")
+            log_file.flush()
+            result = run_stage(args, log_file)
+            result.update(stage=name, rows=rows)
+            results.append(result)
+            print(
+                f"{rows:>9} {name:<12} {result['wall']:>9.2f} {result['cpu']:>9.2f} "
+                f"{result['max_rss_mib']:>10.1f}" + ("" if result["status"] == 0 else " FAILED")
+            )
+            if result["status"] != 0:
+                break
+    return results
+
+
+@click.command()
+@click.option(
+    "-n", "--rows", multiple=True, type=int, default=SIZES,
+    help="Number of bookings, can be given more than once (default: 10k, 100k, 1M)"
+)
+@click.option("-c", "--customers", default=100)
+@click.option("-f", "--files", default=4, help="Number of csv files")
+@click.option("-j", "--jobs", default=1)
+@click.option("--output-format", "fmt", default="yaml")
+@click.option("--json", "json_path", type=Path, default=None, help="Write the results to a file")
+@click.option(
+    "--work_dir", "work_dir", type=Path, default=None,
+    help="Keep data, output and logs in this directory (default: temporary directory)"
+)
+def main(rows, customers, files, jobs, fmt, json_path, work_dir):
+    print(f"{'rows':>9} {'stage':<12} {'wall (s)':>9} {'cpu (s)':>9} {'rss (MiB)':>10}")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_path = (work_dir or Path(tmp_dir)).resolve()
+        work_path.mkdir(parents=True, exist_ok=True)
+        for n in rows:
+            results.extend(run_size(n, work_path, fmt, jobs, customers, files))
+    if json_path:
+        with open(json_path, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,27 @@
 
 import click
 import csv
+import hashlib
 import logging
-import yaml
 
+from collections import defaultdict, namedtuple
 from datetime import datetime
 from decimal import Decimal
+from functools import lru_cache
+from itertools import repeat
 from pathlib import Path
+from stoier import serialize
 from stoier.log import setup_logging
+from stoier.timings import phase, timed
 from stoier.utils import (
+    get_date,
     get_latest_file,
+    load_dated,
     iterate_dated_dict,
-    save_yaml,
+    make_dated_dir,
+    map_jobs,
+    save_documents,
+    set_latest_dir,
     NotADateError,
     NotADirError
 )
@@ -22,6 +32,53 @@ logger = logging.getLogger(__name__)
 ROUND = 3
 
 
+@lru_cache(maxsize=None)
+def get_factors(rate):
+    """Returns the factors to get the net and the vat amount from a gross amount."""
+    return Decimal(100) / (100 + rate), Decimal(rate) / (100 + rate)
+
+
+def get_summary(amounts, dates=(), digest=None):
+    """
+    Returns the aggregates of an account: number of bookings, total, total of positive and
+    negative amounts, first and last day and a digest of the bookings.
+    """
+    total = total_in = total_out = 0
+    for amount in amounts:
+        total += amount
+        if amount > 0:
+            total_in += amount
+        elif amount < 0:
+            total_out += amount
+    return {
+        "count": len(amounts),
+        "total": total,
+        "total_in": total_in,
+        "total_out": total_out,
+        "first": min(dates, default=None),
+        "last": max(dates, default=None),
+        "digest": digest
+    }
+
+
+def get_bookings_digest(bookings):
+    return hashlib.sha256(repr(bookings).encode()).hexdigest()
+
+
+class Posting(namedtuple("Posting", ("entry", "amount"))):
+    """
+    A booking on one account: a reference to the entry, which is shared by all accounts
+    the entry is booked to, and the amount booked to this account.
+    """
+
+    __slots__ = ()
+
+    def to_dict(self, acct_amount_col):
+        booking = self.entry.copy()
+        booking[acct_amount_col] = self.amount
+        return booking
+
+
 class Account():
 
     types = ("net", "gross", "vat")
@@ -30,52 +87,101 @@ class Account():
         self.acct_type = acct_type
         self.amount_col = amount_col
         self.bookings = list()
+        self.total = Decimal("0.0")
+        self.first_date = None
+        self.last_date = None
         self.name = name
         self.vat_col = vat_col
         self.vat_amount = vat_amount
 
     def sum(self):
-        acct_amount_col = f"{self.acct_type}_amount"
-        return sum([b[acct_amount_col] for b in self.bookings])
+        return sum([p.amount for p in self.bookings])
+
+    def get_rate(self, vat):
+        """Returns the vat rate in percent, or None if vat is the absolute vat amount."""
+        if vat is True:
+            return self.vat_amount
+        elif isinstance(vat, Decimal):
+            return None
+        elif isinstance(vat, int):
+            return vat
+        raise ValueError(f"Unsupported vat {vat!r} for account {self.name}.")
+
+    def get_amounts(self, amounts, vats):
+        """
+        Returns the amounts booked to this account for columns of (gross) amounts and vats.
+
+        The rows are grouped by vat rate, so the factor is computed once per rate and the
+        result is the same as computing each row on its own.
+        """
+        if self.acct_type == "gross":
+            return list(amounts)
+        rates = defaultdict(list)
+        for i, vat in enumerate(vats):
+            rates[self.get_rate(vat)].append(i)
+        result = [None] * len(amounts)
+        for rate, indices in rates.items():
+            if rate is None:
+                if self.acct_type == "net":
+                    for i in indices:
+                        result[i] = round(amounts[i] - vats[i], ROUND)
+                else:
+                    for i in indices:
+                        result[i] = round(vats[i], ROUND)
+            else:
+                net_factor, vat_factor = get_factors(rate)
+                factor = net_factor if self.acct_type == "net" else vat_factor
+                for i in indices:
+                    result[i] = round(amounts[i] * factor, ROUND)
+        return result
+
+    def add_bookings(self, bookings, dates=None):
+        """Books the bookings. dates are the days ("%Y-%m-%d") of the bookings, if known."""
+        if self.acct_type == "gross":
+            vats = None
+        else:
+            vats = [b[self.vat_col] for b in bookings]
+        amounts = self.get_amounts([b[self.amount_col] for b in bookings], vats)
+        postings = [Posting(booking, amount) for booking, amount in zip(bookings, amounts)]
+        self.bookings.extend(postings)
+        for amount in amounts:
+            self.total += amount
+        if dates:
+            first, last = min(dates), max(dates)
+            if self.first_date is None or first < self.first_date:
+                self.first_date = first
+            if self.last_date is None or last > self.last_date:
+                self.last_date = last
+        return postings
 
     def add_booking(self, booking):
-        b = booking.copy()
-        logger.debug(b)
-        if self.acct_type == "net":
-            vat = b[self.vat_col]
-            if vat is True:
-                b["net_amount"] = round(
-                    b[self.amount_col] * (Decimal(100) / (100 + self.vat_amount)), ROUND
-                )
-            elif isinstance(vat, Decimal):
-                b["net_amount"] = round(b[self.amount_col] - vat, ROUND)
-            elif isinstance(vat, int):
-                b["net_amount"] = round(b[self.amount_col] * (Decimal(100) / (100 + vat)), ROUND)
-        elif self.acct_type == "vat":
-            vat = b[self.vat_col]
-            if vat is True:
-                b["vat_amount"] = round(
-                    b[self.amount_col] * (Decimal(self.vat_amount) / (100 + self.vat_amount)),
-                    ROUND
-                )
-            elif isinstance(vat, Decimal):
-                b["vat_amount"] = round(vat, ROUND)
-            elif isinstance(vat, int):
-                b["vat_amount"] = round(
-                    b[self.amount_col] * (Decimal(vat) / (100 + vat)), ROUND
-                )
-        else:
-            b["gross_amount"] = b[self.amount_col]
-        self.bookings.append(b)
-        return b
+        return self.add_bookings([booking])[0]
+
+    def get_summary(self, bookings):
+        dates = [d for d in (self.first_date, self.last_date) if d is not None]
+        return get_summary(
+            [p.amount for p in self.bookings], dates, get_bookings_digest(bookings)
+        )
 
     def serialize(self):
+        acct_amount_col = f"{self.acct_type}_amount"
+        bookings = [p.to_dict(acct_amount_col) for p in self.bookings]
         return {
             "name": self.name,
             "type": self.acct_type,
-            "bookings": self.bookings
+            "summary": self.get_summary(bookings),
+            "bookings": bookings
         }
 
+    def to_documents(self):
+        """
+        Returns the account as two documents: a header with name, type and summary and
+        the list of bookings, so the header can be read without reading the bookings.
+        """
+        account_data = self.serialize()
+        bookings = account_data.pop("bookings")
+        return [account_data, bookings]
+
 
 class AccountedBook():
 
@@ -111,46 +217,46 @@ class AccountedBook():
         yield (f"{self.vat_name}_out", "vat")
 
     def add_entries_from_yaml(self, data_file, assign_file):
-        data = yaml.load(data_file, Loader=yaml.Loader)
-        assign_data = yaml.load(assign_file, Loader=yaml.Loader)
+        self.add_entries(serialize.load(data_file), serialize.load(assign_file))
+
+    def add_entries(self, data, assign_data):
+        """
+        Books all entries. The entries are first collected per account and then booked
+        in one batch per account (see Account.get_amounts).
+        """
         self.accounts = {
             acct: Account(acct, acct_type) for acct, acct_type in self.all_accounts(assign_data)
         }
+        postings = defaultdict(list)
         for date, e, entry in iterate_dated_dict(data):
             logging.debug(entry)
-            # row for csv export
+            # row for csv export, only the accounts the entry is booked to are added
             row = {h: entry[h] for h in self.header}
-            row.update(
-                dict.fromkeys(
-                    list(self.accounts.keys()), None
-                )
-            )
 
             assignments = assign_data[date][e]
-            types = {
-                "gross": assignments["gross_accounts"],
-                "net": assignments["net_accounts"]
-            }
             entry["vat"] = assignments["vat"]
-            for acct_type, account_list in types.items():
-                for account in account_list:
-                    booked_entry = self.accounts[account].add_booking(entry)
-                    row[account] = booked_entry[f"{acct_type}_amount"]
+            for account in assignments["gross_accounts"] + assignments["net_accounts"]:
+                postings[account].append((date, entry, row))
 
             # Handle VAT
             vat = entry["vat"]
             in_out = "in" if entry[self.amount_col] > 0 else "out"
             if isinstance(vat, int):
-                booked_entry = (
-                    self.accounts[f"{self.vat_name}_{str(vat)}_{in_out}"].add_booking(entry)
-                )
-                row[f"{self.vat_name}_{str(vat)}_{in_out}"] = booked_entry["vat_amount"]
+                postings[f"{self.vat_name}_{str(vat)}_{in_out}"].append((date, entry, row))
             else:
-                booked_entry = self.accounts[f"{self.vat_name}_{in_out}"].add_booking(entry)
-                row[f"{self.vat_name}_{in_out}"] = booked_entry["vat_amount"]
+                postings[f"{self.vat_name}_{in_out}"].append((date, entry, row))
 
             self.spreadsheet.append(row)
 
+        for name, account_postings in postings.items():
+            account = self.accounts[name]
+            booked = account.add_bookings(
+                [entry for date, entry, row in account_postings],
+                [date for date, entry, row in account_postings]
+            )
+            for (date, entry, row), posting in zip(account_postings, booked):
+                row[name] = posting.amount
+
         # Remove useless 0% VAT accounts
         for in_out in ("in", "out"):
             if f"vat_0_{in_out}" in self.accounts.keys():
@@ -159,18 +265,30 @@ class AccountedBook():
         self.entries.update(data)
 
     def get_sums(self, csv_accounts):
-        sums = dict.fromkeys(csv_accounts, Decimal("0.0"))
-        for row in self.spreadsheet:
-            for account in csv_accounts:
-                value = row[account]
-                if value is not None:
-                    sums[account] += value
-        return sums
-
-    def to_files(self, out_path, now, no_gross_csv):
-        for name, account in self.accounts.items():
-            save_yaml(account.serialize(), out_path, prefix=f"{name}_", date=now)
-
+        return {name: self.accounts[name].total for name in csv_accounts}
+
+    def to_files(self, out_path, now, no_gross_csv, fmt="yaml", jobs=1):
+        self.save_accounts(out_path, now, fmt, jobs)
+        self.to_csv(out_path, now, no_gross_csv)
+
+    def save_accounts(self, out_path, now, fmt="yaml", jobs=1):
+        """
+        Writes one file per account with a header and the bookings (see
+        Account.to_documents). If jobs > 1, the files are written in parallel.
+        """
+        for _ in map_jobs(
+                save_documents,
+                (account.to_documents() for account in self.accounts.values()),
+                repeat(out_path),
+                (f"{name}_" for name in self.accounts.keys()),
+                repeat(now),
+                repeat(fmt),
+                repeat(False),
+                jobs=jobs
+        ):
+            pass
+
+    def to_csv(self, out_path, now, no_gross_csv):
         if no_gross_csv:
             csv_accounts = []
             for acct_name, acct in self.accounts.items():
@@ -181,6 +299,7 @@ class AccountedBook():
         csv_path = out_path / f"{now.isoformat()}.csv"
         with open(csv_path, "w") as csv_file:
             fieldnames = self.header + csv_accounts
+            # Rows are sparse, missing accounts are written as empty cells.
             writer = csv.DictWriter(csv_file, fieldnames=fieldnames, extrasaction="ignore")
             writer.writeheader()
             writer.writerow(self.get_sums(csv_accounts))
@@ -189,6 +308,7 @@ class AccountedBook():
 
 
 @click.command()
+@timed
 @click.option("-d", "--debug", is_flag=True, default=False)
 @click.option("-v", "--verbose", is_flag=True, default=False)
 @click.option("--amount_col", "amount_col", default="amount")
@@ -198,6 +318,14 @@ class AccountedBook():
 @click.option(
     "--no-gross-csv", help="Exclude gross accounts from csv export", is_flag=True, default=False
 )
+@click.option(
+    "--output-format", "fmt", type=click.Choice(serialize.FORMATS.keys()), default="yaml"
+)
+@click.option("-f", "--format", "date_format", default="%d.%m.%Y")
+@click.option("-s", "--start", "start_str", default=None)
+@click.option("-e", "--end", "end_str", default=None)
+@click.option("-y", "--year", "year", type=int, default=None, help="Only account this year")
+@click.option("-j", "--jobs", help="Number of processes used to write accounts", default=1)
 @click.argument("out_dir")
 @click.argument("data_filename")
 @click.argument("assign_filename")
@@ -209,12 +337,25 @@ def account(
     vat_col,
     header_str,
     no_gross_csv,
+    fmt,
+    date_format,
+    start_str,
+    end_str,
+    year,
+    jobs,
     out_dir,
     data_filename,
     assign_filename
 ):
     setup_logging(debug, verbose)
 
+    if year:
+        start = datetime(year, 1, 1)
+        end = datetime(year, 12, 31)
+    else:
+        start = get_date(start_str, date_format)
+        end = get_date(end_str, date_format)
+
     if header_str:
         header = header_str.split(":")
     else:
@@ -230,17 +371,17 @@ def account(
 
     logger.debug(f"Using {filepath} as datafile.")
     logger.debug(f"Using {assign_filepath} as assign file.")
-    with (
-        open(filepath) as data_file,
-        open(assign_filepath) as assign_file
-    ):
-        a_book.add_entries_from_yaml(data_file, assign_file)
+    with phase("load"):
+        data = load_dated(filepath, start, end)
+        assign_data = load_dated(assign_filepath, start, end)
+    with phase("transform"):
+        a_book.add_entries(data, assign_data)
 
     now = datetime.now()
-    out_path = Path(out_dir) / "05_accounts" / now.isoformat()
-    if not out_path.is_dir():
-        out_path.mkdir(parents=True)
-    a_book.to_files(out_path, now, no_gross_csv)
+    out_path = make_dated_dir(Path(out_dir) / "05_accounts", now)
+    with phase("save"):
+        a_book.to_files(out_path, now, no_gross_csv, fmt, jobs)
+        set_latest_dir(out_path, now)
 
 
 if __name__ == "__main__":
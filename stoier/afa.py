@@ -1,18 +1,23 @@
 #!/usr/bin/env python3
 
 import click
+import csv
 import logging
-import yaml
+import os
 
 from datetime import datetime
 from decimal import Decimal
 from pathlib import Path
+from stoier import serialize
 from stoier.log import setup_logging
+from stoier.timings import phase, timed
+from stoier.utils import save_yaml
 
 logger = logging.getLogger(__name__)
 
 
 ROUND = 3
+INDEX_NAME = ".afa_index.yml"
 
 
 class AfaYearError(Exception):
@@ -27,25 +32,41 @@ class Afa:
         description,
         price,
         date_of_purchase,
-        estimated_lifetime
+        estimated_lifetime,
+        components=None
     ):
         self.name = name
         self.description = description
         self.price = price
         self.date_of_purchase = date_of_purchase
         self.estimated_lifetime = estimated_lifetime
+        self.components = components
 
     @classmethod
     def from_yaml(cls, yaml_file):
-        data = yaml.safe_load(yaml_file)
+        return cls.from_dict(serialize.safe_load(yaml_file))
+
+    @classmethod
+    def from_dict(cls, data):
         return cls(
             data["name"],
             data["description"],
             Decimal(data["price"]),
             data["date_of_purchase"],
-            data["estimated_lifetime_years"]
+            data["estimated_lifetime_years"],
+            data.get("components")
         )
 
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "description": self.description,
+            "price": self.price,
+            "date_of_purchase": self.date_of_purchase,
+            "estimated_lifetime_years": self.estimated_lifetime,
+            "components": self.components
+        }
+
     def get_afa_value(self, year=None):
         """Returns the afa for last year (default) or any other year."""
         if year is None:
@@ -74,34 +95,241 @@ class Afa:
         else:  # after end of lifetime
             return Decimal("0.0")
 
-    def get_afa(self, year):
+    def get_years(self):
+        """Returns the years with afa: the year of purchase up to the last (partial) year."""
+        first_year = self.date_of_purchase.year
+        return range(first_year, first_year + self.estimated_lifetime + 2)
+
+    def get_schedule(self):
+        """
+        Returns the afa for all years in get_years as dict. The values of the first, a full
+        and the last year are computed once.
+        """
+        years = self.get_years()
+        first_year = years[0]
+        values = {
+            "first": self.get_afa_value(first_year),
+            "full": self.get_afa_value(first_year + 1),
+            "last": self.get_afa_value(years[-1])
+        }
+        schedule = dict()
+        for year in years:
+            if year == first_year:
+                schedule[year] = values["first"]
+            elif year - first_year <= self.estimated_lifetime:
+                schedule[year] = values["full"]
+            else:
+                schedule[year] = values["last"]
+        return schedule
+
+    def get_info(self):
         return (
             self.name,
             self.description,
             round(self.price, ROUND),
             self.date_of_purchase,
-            self.estimated_lifetime,
-            self.get_afa_value(year)
+            self.estimated_lifetime
         )
 
+    def get_afa(self, year):
+        return (*self.get_info(), self.get_afa_value(year))
+
+
+class AfaSchedule:
+    """Table of the afa of all assets (rows) in all years (columns) with totals per year."""
+
+    header = ["name", "description", "price", "date_of_purchase", "estimated_lifetime"]
+
+    def __init__(self):
+        self.assets = list()
+        self.schedules = list()
+        self.totals = dict()
+
+    @property
+    def years(self):
+        return sorted(self.totals.keys())
+
+    def add_afa(self, afa):
+        schedule = afa.get_schedule()
+        self.assets.append(afa)
+        self.schedules.append(schedule)
+        for year, value in schedule.items():
+            self.totals[year] = self.totals.get(year, 0) + value
+
+    def add_afas(self, afas):
+        for afa in afas:
+            self.add_afa(afa)
+
+    def serialize(self):
+        return {
+            "assets": [
+                {**dict(zip(self.header, afa.get_info())), "afa": schedule}
+                for afa, schedule in zip(self.assets, self.schedules)
+            ],
+            "totals": {year: self.totals[year] for year in self.years}
+        }
+
+    def to_files(self, out_path, now, fmt="yaml"):
+        self.to_csv(out_path, now)
+        save_yaml(self.serialize(), out_path, date=now, fmt=fmt)
+
+    def to_csv(self, out_path, now):
+        csv_path = out_path / f"{now.isoformat()}.csv"
+        with open(csv_path, "w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.header + self.years)
+            writer.writeheader()
+            writer.writerow(self.totals)
+            for afa, schedule in zip(self.assets, self.schedules):
+                row = dict(zip(self.header, afa.get_info()))
+                row.update(schedule)
+                writer.writerow(row)
+        logger.info(f"Written {len(self.assets)} assets to {csv_path}")
+
+    def print_totals(self):
+        for year in self.years:
+            print(f"{year}: {round(self.totals[year], ROUND)}")
+
+
+class AfaIndex:
+    """
+    Index of the afa files in a directory, stored in INDEX_NAME in the directory. For each
+    file, the size, mtime and the parsed fields are kept, so only new or changed files are
+    parsed again.
+    """
+
+    def __init__(self, afa_dir):
+        self.afa_dir = afa_dir
+        self.index_path = afa_dir / INDEX_NAME
+        self.entries = dict()
+
+    def load(self):
+        if self.index_path.is_file():
+            try:
+                self.entries = serialize.load_file(self.index_path)
+            except serialize.LOAD_ERRORS as e:
+                logger.warning(f"Ignoring broken index {self.index_path}: {e}")
+
+    def save(self):
+        """Writes the index. It is only a cache, so errors (e.g. read-only dirs) are logged."""
+        tmp_path = self.index_path.with_name(
+            f"{self.index_path.stem}.tmp{self.index_path.suffix}"
+        )
+        try:
+            serialize.dump_file(self.entries, tmp_path)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not write index {self.index_path}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return
+        logger.debug(f"Written index of {len(self.entries)} files to {self.index_path}")
+
+    def update(self):
+        """Parses new and changed files, removes deleted files and saves the index."""
+        self.load()
+        entries = dict()
+        changed = False
+        for filepath in sorted(self.afa_dir.glob("*.yaml")):
+            stat = filepath.stat()
+            entry = self.entries.get(filepath.name)
+            if entry is None or (entry["mtime_ns"], entry["size"]) != (
+                    stat.st_mtime_ns, stat.st_size
+            ):
+                logger.debug(f"Parsing {filepath}")
+                with open(filepath) as data_file:
+                    afa = Afa.from_yaml(data_file)
+                entry = {
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "afa": afa.to_dict()
+                }
+                changed = True
+            entries[filepath.name] = entry
+        if changed or entries.keys() != self.entries.keys():
+            self.entries = entries
+            self.save()
+
+    def get_afas(self, purchase_year=None, lifetime=None):
+        """Yields the indexed afas, optionally only those with this purchase year/lifetime."""
+        for entry in self.entries.values():
+            data = entry["afa"]
+            if purchase_year is not None and data["date_of_purchase"].year != purchase_year:
+                continue
+            if lifetime is not None and data["estimated_lifetime_years"] != lifetime:
+                continue
+            yield Afa.from_dict(data)
+
+
+def read_afas(afa_dir, purchase_year=None, lifetime=None, use_index=True):
+    if use_index:
+        index = AfaIndex(afa_dir)
+        index.update()
+        yield from index.get_afas(purchase_year, lifetime)
+        return
+    for filepath in afa_dir.glob("*.yaml"):
+        with open(filepath) as data_file:
+            afa = Afa.from_yaml(data_file)
+        if purchase_year is not None and afa.date_of_purchase.year != purchase_year:
+            continue
+        if lifetime is not None and afa.estimated_lifetime != lifetime:
+            continue
+        yield afa
+
 
 @click.command()
+@timed
 @click.option("-d", "--debug", is_flag=True, default=False)
 @click.option("-v", "--verbose", is_flag=True, default=False)
 @click.option("-y", "--year", "year", type=int, default=None)
+@click.option(
+    "--schedule", is_flag=True, default=False,
+    help="Compute the afa of all assets in all years and print the totals per year"
+)
+@click.option(
+    "-o", "--out_dir", "out_dir", default=None,
+    help="Write the schedule as csv and yaml/pickle file to OUT_DIR/07_afa"
+)
+@click.option(
+    "--output-format", "fmt", type=click.Choice(serialize.FORMATS.keys()), default="yaml"
+)
+@click.option("--purchase-year", type=int, default=None, help="Only assets bought this year")
+@click.option("--lifetime", type=int, default=None, help="Only assets with this lifetime")
+@click.option(
+    "--no-index", "no_index", is_flag=True, default=False,
+    help=f"Parse all files instead of using the index ({INDEX_NAME} in AFA_DIR)"
+)
 @click.argument("afa_dir", type=Path)
 def afa_helper(
     debug,
     verbose,
     year,
+    schedule,
+    out_dir,
+    fmt,
+    purchase_year,
+    lifetime,
+    no_index,
     afa_dir
 ):
     setup_logging(debug, verbose)
 
     logger.debug(f"Using files from {afa_dir} as data source.")
-    for filepath in afa_dir.glob("*.yaml"):
-        with open(filepath) as data_file:
-            afa = Afa.from_yaml(data_file)
+    with phase("load"):
+        afas = list(read_afas(afa_dir, purchase_year, lifetime, not no_index))
+    if schedule:
+        with phase("transform"):
+            afa_schedule = AfaSchedule()
+            afa_schedule.add_afas(afas)
+        if out_dir:
+            now = datetime.now()
+            out_path = Path(out_dir) / "07_afa"
+            if not out_path.is_dir():
+                out_path.mkdir(parents=True)
+            with phase("save"):
+                afa_schedule.to_files(out_path, now, fmt)
+        afa_schedule.print_totals()
+        return
+
+    for afa in afas:
         try:
             name, description, price, dop, el, value = afa.get_afa(year)
         except AfaYearError as e:
@@ -2,11 +2,12 @@
 
 import click
 import logging
-import yaml
 
 from decimal import Decimal
 from pathlib import Path
+from stoier import serialize
 from stoier.log import setup_logging
+from stoier.timings import phase, timed
 from stoier.utils import get_latest_file, save_yaml
 
 logger = logging.getLogger(__name__)
@@ -22,7 +23,9 @@ class CleanBook():
         self.entries = list()
 
     def add_entries_from_yaml(self, yaml_file, amount_col, balance_col, details_col):
-        data = yaml.safe_load(yaml_file)
+        self.add_entries(serialize.safe_load(yaml_file), amount_col, balance_col, details_col)
+
+    def add_entries(self, data, amount_col, balance_col, details_col):
         for entry in data:
             entry[amount_col] = decimal_from_postbank(entry[amount_col])
             entry[balance_col] = decimal_from_postbank(entry[balance_col])
@@ -33,32 +36,39 @@ class CleanBook():
             )
         self.entries.extend(data)
 
-    def to_file(self, out_path):
-        save_yaml(self.entries, out_path)
+    def to_file(self, out_path, fmt="yaml"):
+        save_yaml(self.entries, out_path, fmt=fmt)
 
 
 @click.command()
+@timed
 @click.option("-d", "--debug", is_flag=True, default=False)
 @click.option("-v", "--verbose", is_flag=True, default=False)
 @click.option("-b", "--amount_col", "amount_col", default="amount")
 @click.option("-b", "--balance_col", "balance_col", default="balance")
 @click.option("--details_col", "details_col", default="details")
+@click.option(
+    "--output-format", "fmt", type=click.Choice(serialize.FORMATS.keys()), default="yaml"
+)
 @click.argument("out_dir")
 @click.argument("filename")
-def clean(debug, verbose, amount_col, balance_col, details_col, out_dir, filename):
+def clean(debug, verbose, amount_col, balance_col, details_col, fmt, out_dir, filename):
     setup_logging(debug, verbose)
 
     c_book = CleanBook()
 
     filepath = get_latest_file(filename)
-    logger.debug(f"Reading {filename}")
-    with open(filepath) as yaml_file:
-        c_book.add_entries_from_yaml(yaml_file, amount_col, balance_col, details_col)
+    logger.debug(f"Reading {filepath}")
+    with phase("load"):
+        data = serialize.load_file(filepath)
+    with phase("transform"):
+        c_book.add_entries(data, amount_col, balance_col, details_col)
 
     out_path = Path(out_dir) / "02_clean_bookings"
     if not out_path.is_dir():
         out_path.mkdir(parents=True)
-    c_book.to_file(out_path)
+    with phase("save"):
+        c_book.to_file(out_path, fmt)
 
 
 if __name__ == "__main__":
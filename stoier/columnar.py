@@ -0,0 +1,248 @@
+"""
+Columnar cache of dated dicts (the unique bookings).
+
+02_deduplicate writes "<isoformat>.columns" next to the bookings file "<isoformat>.yml". It
+contains one file per column and a meta file with the days (name, first row, number of
+rows), the column types and the size and mtime of the bookings file. Readers mmap the
+column files and only read the columns and days they need. If the cache is missing or
+does not match the bookings file (e.g. it has been edited), the bookings file is read.
+
+Column types:
+ cents: Decimals with two decimal places as int64 cents
+ int: int64
+ str: int32 codes of interned strings (-1 is None). The strings are stored utf-8 encoded
+      in "<column>.strings" with their offsets in "<column>.offsets".
+"""
+
+import json
+import logging
+import mmap
+import os
+import shutil
+import sys
+
+from array import array
+from decimal import Decimal
+from itertools import accumulate, chain
+from stoier import serialize
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = ".columns"
+META_NAME = "meta.json"
+VERSION = 1
+DATE_FORMAT = "%Y-%m-%d"
+# Type of a column -> (suffix of the values file, typecode of the values)
+COLUMN_FILES = {
+    "cents": (".cents", "q"),
+    "int": (".ints", "q"),
+    "str": (".codes", "i")
+}
+
+
+class NotCacheableError(Exception):
+    pass
+
+
+def get_columns_path(filepath):
+    """Returns the path of the columnar cache belonging to a bookings file."""
+    return filepath.parent / f"{serialize.get_stem(filepath)}{SUFFIX}"
+
+
+def get_column_type(values):
+    if all(
+        isinstance(v, Decimal) and v.is_finite() and v.as_tuple().exponent == -2
+        for v in values
+    ):
+        return "cents"
+    if all(type(v) is int for v in values):
+        return "int"
+    if all(v is None or isinstance(v, str) for v in values):
+        return "str"
+    raise NotCacheableError("Column has values of other or mixed types")
+
+
+def write_column(out_path, name, values):
+    """Writes the files of a column and returns its type."""
+    column_type = get_column_type(values)
+    suffix, typecode = COLUMN_FILES[column_type]
+    if column_type == "cents":
+        column = array(typecode, (int(v.scaleb(2)) for v in values))
+    elif column_type == "int":
+        column = array(typecode, values)
+    else:
+        strings = dict()
+        column = array(typecode, (-1 if v is None else strings.setdefault(v, len(strings))
+                                  for v in values))
+        encoded = [s.encode() for s in strings]
+        offsets = array("Q", accumulate((len(s) for s in encoded), initial=0))
+        with open(out_path / f"{name}.strings", "wb") as strings_file:
+            strings_file.write(b"".join(encoded))
+        with open(out_path / f"{name}.offsets", "wb") as offsets_file:
+            offsets.tofile(offsets_file)
+    with open(out_path / f"{name}{suffix}", "wb") as column_file:
+        column.tofile(column_file)
+    return column_type
+
+
+def save_columns(obj, filepath):
+    """
+    Writes the columnar cache of the dated dict obj, which has been written to filepath.
+    Returns the path of the cache or None if obj cannot be cached (e.g. different keys or
+    values which are not Decimal, int or str).
+    """
+    # The cache has to return the same dict as loading filepath. yaml sorts the keys of
+    # mappings, pickle keeps their order.
+    if serialize.is_pickle(filepath):
+        days, get_keys = list(obj), tuple
+    else:
+        days, get_keys = sorted(obj), lambda entry: tuple(sorted(entry))
+    out_path = get_columns_path(filepath)
+    tmp_path = out_path.with_name(f".{out_path.name}.tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir()
+    try:
+        entries = [entry for date_str in days for entry in obj[date_str]]
+        names = get_keys(entries[0]) if entries else ()
+        if any(get_keys(entry) != names for entry in entries):
+            raise NotCacheableError("Entries have different keys")
+        columns = dict()
+        for name in names:
+            if "/" in name or name.startswith("."):
+                raise NotCacheableError(f"Column name {name!r} is not a valid filename")
+            columns[name] = write_column(tmp_path, name, [entry[name] for entry in entries])
+    except (NotCacheableError, OverflowError, UnicodeEncodeError) as e:
+        logger.info(f"Not writing columns of {filepath}: {e}")
+        shutil.rmtree(tmp_path)
+        return None
+
+    first_rows = accumulate((len(obj[date_str]) for date_str in days), initial=0)
+    stat = filepath.stat()
+    meta = {
+        "version": VERSION,
+        "byteorder": sys.byteorder,
+        "source": {"name": filepath.name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+        "rows": len(entries),
+        "columns": columns,
+        "days": [
+            [date_str, first_row, len(obj[date_str])]
+            for date_str, first_row in zip(days, first_rows)
+        ]
+    }
+    with open(tmp_path / META_NAME, "w") as meta_file:
+        json.dump(meta, meta_file)
+    if out_path.exists():
+        shutil.rmtree(out_path)
+    os.replace(tmp_path, out_path)
+    logger.info(f"Written {len(columns)} columns of {len(entries)} items to {out_path}")
+    return out_path
+
+
+def load_meta(filepath):
+    """Returns the meta data of the cache of filepath or None if it is missing or stale."""
+    try:
+        with open(get_columns_path(filepath) / META_NAME) as meta_file:
+            meta = json.load(meta_file)
+        stat = filepath.stat()
+    except (OSError, ValueError):
+        return None
+    source = meta.get("source", {})
+    if (
+        meta.get("version") != VERSION
+        or meta.get("byteorder") != sys.byteorder
+        or source.get("name") != filepath.name
+        or source.get("size") != stat.st_size
+        or source.get("mtime_ns") != stat.st_mtime_ns
+    ):
+        logger.debug(f"Ignoring stale columns of {filepath}")
+        return None
+    return meta
+
+
+class ColumnReader:
+    """Reads rows of the columns of a cache from mmaps. Use it as a context manager."""
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.maps = list()
+        self.views = list()
+        self.strings = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        for mapped in self.maps:
+            mapped.close()
+        self.views = list()
+        self.maps = list()
+
+    def get_view(self, filename, typecode="B"):
+        with open(self.path / filename, "rb") as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return memoryview(b"").cast(typecode)
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        view = memoryview(mapped).cast(typecode)
+        self.views.append(view)
+        return view
+
+    def get_string(self, name, code):
+        """Returns the interned string code of column name. Strings are decoded once."""
+        if code < 0:
+            return None
+        if name not in self.strings:
+            self.strings[name] = (
+                self.get_view(f"{name}.offsets", "Q"), self.get_view(f"{name}.strings"), dict()
+            )
+        offsets, data, decoded = self.strings[name]
+        if code not in decoded:
+            decoded[code] = str(data[offsets[code]:offsets[code + 1]], "utf-8")
+        return decoded[code]
+
+    def get_values(self, name, ranges):
+        """Returns the values of column name in the row ranges ((start, stop), ...)."""
+        column_type = self.meta["columns"][name]
+        suffix, typecode = COLUMN_FILES[column_type]
+        view = self.get_view(f"{name}{suffix}", typecode)
+        values = chain.from_iterable(view[start:stop].tolist() for start, stop in ranges)
+        if column_type == "cents":
+            return [Decimal(v).scaleb(-2) for v in values]
+        if column_type == "str":
+            return [self.get_string(name, v) for v in values]
+        return list(values)
+
+
+def load_columns(filepath, columns=None, start=None, end=None):
+    """
+    Returns the dated dict written to filepath from its columnar cache or None if there is
+    no valid cache. If columns is given, the entries only contain these columns. If start
+    and/or end (datetime, inclusive) are given, only days in this range are read.
+    """
+    meta = load_meta(filepath)
+    if meta is None:
+        return None
+    names = [name for name in meta["columns"] if columns is None or name in columns]
+    start_str = start.strftime(DATE_FORMAT) if start else None
+    end_str = end.strftime(DATE_FORMAT) if end else None
+    days = [
+        (date_str, first_row, n_rows) for date_str, first_row, n_rows in meta["days"]
+        if (not start_str or date_str >= start_str) and (not end_str or date_str <= end_str)
+    ]
+    ranges = [(first_row, first_row + n_rows) for _, first_row, n_rows in days]
+
+    path = get_columns_path(filepath)
+    logger.debug(f"Reading columns {', '.join(names)} from {path}")
+    with ColumnReader(path, meta) as reader:
+        values = [reader.get_values(name, ranges) for name in names]
+    rows = iter([dict(zip(names, row)) for row in zip(*values)] if names else [])
+    return {
+        date_str: [next(rows, {}) for _ in range(n_rows)] for date_str, _, n_rows in days
+    }
@@ -4,56 +4,85 @@ import click
 import csv
 import logging
 
+from functools import partial
 from pathlib import Path
+from stoier import serialize
 from stoier.log import setup_logging
-from stoier.utils import save_yaml
+from stoier.timings import phase, timed
+from stoier.utils import map_jobs, save_yaml, YamlListWriter
 
 logger = logging.getLogger(__name__)
 
 
 class Book:
+    """
+    Collects the entries of one or more csv files.
+
+    If a writer is given, entries are passed on to it immediately instead of being kept
+    in memory (see stoier.utils.YamlListWriter).
+    """
 
-    def __init__(self):
+    def __init__(self, writer=None):
         self.entries = []
+        self.writer = writer
+        self.n_entries = 0
 
     def add_entry(self, entry):
-        self.entries.append(entry)
+        self.n_entries += 1
+        if self.writer is None:
+            self.entries.append(entry)
+        else:
+            self.writer.write(entry)
 
-    def add_entries_from_csv(self, csv_file, skip=0, trigger=None, header=True):
-        reader = csv.reader(csv_file, delimiter=";")
-        logger.debug(f"Using trigger: {trigger}")
+    def add_entries(self, entries):
         n_entries = 0
-        for r, row in enumerate(reader):
-            if trigger:
-                if not row:
-                    continue
-                logger.debug(f"{r}: {row}")
-                if row[trigger[0]] == trigger[1] and row:
-                    skip = r + trigger[2]
-                    logger.debug(
-                        f"Skipped {r} rows until trigger found. Starting in {trigger[2]} rows."
-                    )
-                    trigger = None
-                else:
-                    continue
-            if r < skip:
-                continue
-            if r == skip:
-                if not header:
-                    header = row
-                    logger.debug(f"Found header: {header}")
-                    continue
-                else:
-                    logger.debug(f"Using custom header: {header}")
+        for entry in entries:
             n_entries += 1
-            self.add_entry(dict(zip(header, row)))
-        logger.info(f"{n_entries} entries (total: {len(self.entries)}) added from csv file.")
+            self.add_entry(entry)
+        logger.info(f"{n_entries} entries (total: {self.n_entries}) added from csv file.")
+
+    def add_entries_from_csv(self, csv_file, skip=0, trigger=None, header=True):
+        self.add_entries(read_csv_entries(csv_file, skip, trigger, header))
 
-    def to_file(self, out_path, reverse=False):
+    def to_file(self, out_path, reverse=False, fmt="yaml"):
         if reverse:
-            save_yaml([e for e in reversed(self.entries)], out_path)
+            save_yaml([e for e in reversed(self.entries)], out_path, fmt=fmt)
         else:
-            save_yaml(self.entries, out_path)
+            save_yaml(self.entries, out_path, fmt=fmt)
+
+
+def read_csv_entries(csv_file, skip=0, trigger=None, header=True):
+    reader = csv.reader(csv_file, delimiter=";")
+    logger.debug(f"Using trigger: {trigger}")
+    for r, row in enumerate(reader):
+        if trigger:
+            if not row:
+                continue
+            logger.debug(f"{r}: {row}")
+            if row[trigger[0]] == trigger[1] and row:
+                skip = r + trigger[2]
+                logger.debug(
+                    f"Skipped {r} rows until trigger found. Starting in {trigger[2]} rows."
+                )
+                trigger = None
+            else:
+                continue
+        if r < skip:
+            continue
+        if r == skip:
+            if not header:
+                header = row
+                logger.debug(f"Found header: {header}")
+                continue
+            else:
+                logger.debug(f"Using custom header: {header}")
+        yield dict(zip(header, row))
+
+
+def read_csv_file(csv_filename, encoding, skip, trigger, header):
+    """Returns all entries of a csv file as a list, used by the worker processes."""
+    with open(csv_filename, encoding=encoding) as csv_file:
+        return list(read_csv_entries(csv_file, skip, trigger, header))
 
 
 def get_trigger(trigger_str):
@@ -81,34 +110,84 @@ def get_header(header_str):
     return header_str.split(":")
 
 
+def add_csv_files(book, csv_filenames, encoding, skip, trigger, header, jobs=1):
+    """
+    Adds the entries of all csv files to the book.
+
+    If jobs > 1, the files are parsed in a pool of worker processes. The results are added
+    in the order of csv_filenames, so the book is the same as in a serial run.
+    """
+    if jobs > 1:
+        read_fct = partial(
+            read_csv_file, encoding=encoding, skip=skip, trigger=trigger, header=header
+        )
+        for csv_filename, entries in zip(
+                csv_filenames, map_jobs(read_fct, csv_filenames, jobs=jobs)
+        ):
+            logger.debug(csv_filename)
+            book.add_entries(entries)
+        return
+
+    for csv_filename in csv_filenames:
+        logger.debug(csv_filename)
+        with open(csv_filename, encoding=encoding) as csv_file:
+            book.add_entries_from_csv(csv_file, skip, trigger, header)
+
+
 @click.command()
+@timed
 @click.option("-s", "--skip", default=0)
 @click.option("-r", "--reverse", "reverse", is_flag=True, default=False)
 @click.option("-h", "--header", "header_str", default=None)
 @click.option("-t", "--trigger", "trigger_str", default=None)
 @click.option("-e", "--encoding", default="iso-8859-1")
+@click.option("-j", "--jobs", help="Number of processes used to parse files", default=1)
+@click.option(
+    "--stream", help="Write entries while reading instead of collecting them first",
+    is_flag=True, default=False
+)
+@click.option(
+    "--output-format", "fmt", type=click.Choice(serialize.FORMATS.keys()), default="yaml"
+)
 @click.option("-d", "--debug", is_flag=True, default=False)
 @click.option("-v", "--verbose", is_flag=True, default=False)
 @click.argument("out_dir")
 @click.argument("csv_filenames", nargs=-1)
 def csv_to_yml(
-        debug, verbose, reverse, header_str, trigger_str, skip, encoding, out_dir, csv_filenames
+        debug,
+        verbose,
+        reverse,
+        header_str,
+        trigger_str,
+        skip,
+        encoding,
+        stream,
+        jobs,
+        fmt,
+        out_dir,
+        csv_filenames
 ):
     setup_logging(debug, verbose)
+    if stream and not fmt.startswith("yaml"):
+        raise click.UsageError("--stream is only supported for the yaml formats.")
 
     trigger = get_trigger(trigger_str)
     header = get_header(header_str)
-    book = Book()
-
-    for csv_filename in csv_filenames:
-        logger.debug(csv_filename)
-        with open(csv_filename, encoding=encoding) as csv_file:
-            book.add_entries_from_csv(csv_file, skip, trigger, header)
 
     out_path = Path(out_dir) / "01_bookings"
     if not out_path.is_dir():
         out_path.mkdir(parents=True)
-    book.to_file(out_path, reverse)
+
+    if stream:
+        with phase("stream"), YamlListWriter(out_path, reverse=reverse, fmt=fmt) as writer:
+            book = Book(writer)
+            add_csv_files(book, csv_filenames, encoding, skip, trigger, header, jobs)
+    else:
+        book = Book()
+        with phase("load"):
+            add_csv_files(book, csv_filenames, encoding, skip, trigger, header, jobs)
+        with phase("save"):
+            book.to_file(out_path, reverse, fmt)
 
 
 if __name__ == "__main__":
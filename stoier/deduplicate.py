@@ -1,59 +1,165 @@
 #!/usr/bin/env python3
 
 import click
+import hashlib
 import logging
-import yaml
 
 from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
+from stoier import serialize
+from stoier.columnar import save_columns
 from stoier.log import setup_logging
-from stoier.utils import get_date, get_latest_file, save_yaml
+from stoier.store import PARTITIONS
+from stoier.timings import phase, timed
+from stoier.utils import (
+    get_date,
+    get_latest_file,
+    is_latest_fresh,
+    keep_latest_fresh,
+    load_dated,
+    save_dated,
+    save_yaml,
+    set_latest,
+    NotADateError
+)
 
 logger = logging.getLogger(__name__)
 
 
+def get_digest(entry):
+    """
+    Returns a stable digest of the content of an entry (without its id).
+
+    Unlike hash() it does not change between processes, so it can be persisted.
+    """
+    entry_hash = hashlib.blake2b(digest_size=16)
+    for key, value in sorted(entry.items()):
+        if key == "id":
+            continue
+        entry_hash.update(f"{key}\x1f{value!r}\x1e".encode())
+    return entry_hash.hexdigest()
+
+
+def get_digests_path(filepath):
+    """Returns the path of the digest index belonging to a unique bookings file."""
+    return filepath.parent / f"digests_{serialize.get_stem(filepath)}.txt"
+
+
 class UniqueBook():
 
     def __init__(self):
         self.entries = defaultdict(list)
-        self.known_hashes = set()
+        self.known_digests = set()
         self.accounts = set()
+        self.known_accounts = dict()
+
+    def add_known_entries(self, data, digests=None):
+        """
+        Adds the entries of an existing unique bookings file. Their ids are kept, new
+        entries are appended to the days. If digests is None, the digests are computed.
+        """
+        for date_str, entries in data.items():
+            self.entries[date_str].extend(entries)
+        if digests is None:
+            digests = (get_digest(e) for entries in data.values() for e in entries)
+        self.known_digests.update(digests)
+
+    def add_known_accounts(self, accounts):
+        self.known_accounts.update(accounts)
 
     def add_entries_from_yaml(self, yaml_file, start, end, datecol, date_format):
-        data = yaml.load(yaml_file, Loader=yaml.Loader)
+        self.add_entries(serialize.load(yaml_file), start, end, datecol, date_format)
+
+    def add_entries(self, data, start, end, datecol, date_format):
+        n_entries = 0
         for entry in data:
 
             # Hashing and Deduplication
-            entry_hash = hash(frozenset(entry.items()))
-            if entry_hash in self.known_hashes:
+            entry_digest = get_digest(entry)
+            if entry_digest in self.known_digests:
                 continue
-            else:
-                self.known_hashes.add(entry_hash)
 
             entry_date = get_date(entry[datecol], date_format)
 
             # Date Filtering
+            # Duplicates have the same date, so only digests of added entries are kept.
             if start and entry_date < start:
                 continue
             if end and entry_date > end:
                 continue
 
+            self.known_digests.add(entry_digest)
+            n_entries += 1
+
             self.accounts.add(entry["sender"])
 
             # Order by date
             entries_list = self.entries[entry_date.strftime("%Y-%m-%d")]
             entry["id"] = len(entries_list)
             entries_list.append(entry)
-
-    def to_file(self, out_path, date=None):
-        save_yaml(dict(self.entries), out_path, date=date)
+        logger.info(f"{n_entries} new entries added.")
+
+    def to_file(self, out_path, date=None, fmt="yaml", partition=None):
+        if not date:
+            date = datetime.now()
+        filepath = save_dated(
+            dict(self.entries), out_path, date=date, fmt=fmt, partition=partition
+        )
+        self.save_digests(out_path, date)
+        # Partitioned stores are read by range already
+        if partition is None:
+            with keep_latest_fresh(out_path):
+                save_columns(self.entries, filepath)
+
+    def save_digests(self, out_path, date):
+        fresh = is_latest_fresh(out_path)
+        digests_path = out_path / f"digests_{date.isoformat()}.txt"
+        with open(digests_path, "w") as digests_file:
+            for digest in sorted(self.known_digests):
+                digests_file.write(f"{digest}\n")
+        set_latest(out_path, "digests_", digests_path, date, fresh)
+        logger.info(f"Written {len(self.known_digests)} digests to file {digests_path}")
 
     def save_accounts(self, out_path, date=None):
-        save_yaml(dict.fromkeys(self.accounts), out_path, prefix="accounts_", date=date)
+        accounts = dict.fromkeys(self.accounts)
+        accounts.update(self.known_accounts)
+        save_yaml(accounts, out_path, prefix="accounts_", date=date)
+
+    @classmethod
+    def from_dir(cls, unique_dir):
+        """
+        Returns a book containing the latest unique bookings (and accounts) in unique_dir.
+        If no digest index exists for them, the digests are computed.
+        """
+        u_book = cls()
+        filepath = get_latest_file(unique_dir)
+        logger.debug(f"Using {filepath} as known bookings")
+        digests_path = get_digests_path(filepath)
+        if digests_path.is_file():
+            with open(digests_path) as digests_file:
+                digests = [line.rstrip() for line in digests_file]
+        else:
+            logger.info(f"No digest index for {filepath}, computing the digests.")
+            digests = None
+        u_book.add_known_entries(load_dated(filepath), digests)
+
+        try:
+            acct_filepath = get_latest_file(
+                unique_dir,
+                glob_str="accounts_*",
+                date_extract_fct=lambda f: serialize.get_stem(f)[9:]
+            )
+        except NotADateError:
+            return u_book
+        logger.debug(f"Using {acct_filepath} as known accounts")
+        with serialize.open_file(acct_filepath) as acct_file:
+            u_book.add_known_accounts(serialize.safe_load(acct_file) or {})
+        return u_book
 
 
 @click.command()
+@timed
 @click.option("-d", "--debug", is_flag=True, default=False)
 @click.option("-v", "--verbose", is_flag=True, default=False)
 @click.option("-f", "--format", "date_format", default="%d.%m.%Y")
@@ -61,6 +167,17 @@ class UniqueBook():
 @click.option("--date_col", "date_col", default="date_1")
 @click.option("-e", "--end", "end_str", default=None)
 @click.option("-a", "--with-account-mapping", "with_account_mapping", is_flag=True, default=True)
+@click.option(
+    "--output-format", "fmt", type=click.Choice(serialize.FORMATS.keys()), default="yaml"
+)
+@click.option(
+    "--partition", type=click.Choice(PARTITIONS.keys()), default=None,
+    help="Write a store partitioned by month or year instead of a single file"
+)
+@click.option(
+    "-i", "--incremental", help="Only add bookings unknown to the latest unique bookings",
+    is_flag=True, default=False
+)
 @click.argument("out_dir")
 @click.argument("filename")
 def deduplicate(
@@ -72,26 +189,40 @@ def deduplicate(
     date_format,
     filename,
     date_col,
-    with_account_mapping
+    with_account_mapping,
+    incremental,
+    partition,
+    fmt
 ):
     setup_logging(debug, verbose)
     start = get_date(start_str, date_format)
     end = get_date(end_str, date_format)
 
-    u_book = UniqueBook()
-    filepath = get_latest_file(filename)
-    logger.debug(f"Reading {filepath}")
-    with open(filepath) as yaml_file:
-        u_book.add_entries_from_yaml(yaml_file, start, end, date_col, date_format)
-
     out_path = Path(out_dir) / "03_unique_bookings"
     if not out_path.is_dir():
         out_path.mkdir(parents=True)
 
+    with phase("load"):
+        if incremental:
+            try:
+                u_book = UniqueBook.from_dir(out_path)
+            except NotADateError:
+                logger.info(f"No unique bookings in {out_path} yet, adding all bookings.")
+                u_book = UniqueBook()
+        else:
+            u_book = UniqueBook()
+
+        filepath = get_latest_file(filename)
+        logger.debug(f"Reading {filepath}")
+        data = serialize.load_file(filepath)
+    with phase("transform"):
+        u_book.add_entries(data, start, end, date_col, date_format)
+
     now = datetime.now()
-    u_book.to_file(out_path, date=now)
-    if with_account_mapping:
-        u_book.save_accounts(out_path, date=now)
+    with phase("save"):
+        u_book.to_file(out_path, date=now, fmt=fmt, partition=partition)
+        if with_account_mapping:
+            u_book.save_accounts(out_path, date=now)
 
 
 if __name__ == "__main__":
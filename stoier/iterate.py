@@ -2,17 +2,28 @@
 
 import click
 import logging
-import yaml
 
 from datetime import datetime
 from pprint import pprint
 from stoier.log import setup_logging
-from stoier.utils import get_latest_file, iterate_dated_dict
+from stoier.timings import phase, timed
+from stoier.utils import get_latest_file, iterate_dated_dict, load_dated
 
 logger = logging.getLogger(__name__)
 
 
+def parse_date(date_str, date_format):
+    if not date_str:
+        return None
+    try:
+        return datetime.strptime(date_str, date_format)
+    except ValueError:
+        logger.error(f"{date_str} is not a valid date.")
+        exit(1)
+
+
 @click.command()
+@timed
 @click.option("-f", "--format", "date_format", default="%d.%m.%Y")
 @click.option("-s", "--start", "start_str", default=None)
 @click.option("-e", "--end", "end_str", default=None)
@@ -25,18 +36,12 @@ def iterate(debug, verbose, date_format, start_str, end_str, filename):
     filepath = get_latest_file(filename)
     logger.debug(f"Using {filepath}")
 
-    with open(filepath) as yaml_file:
-        data = yaml.load(yaml_file, Loader=yaml.Loader)
-    if start_str:
-        try:
-            start = datetime.strptime(start_str, date_format)
-        except ValueError:
-            logger.error(f"{start_str} is not a valid date.")
-            exit(1)
-    else:
-        start = None
-
-    for date_str, e, entry in iterate_dated_dict(data, start=start):
+    start = parse_date(start_str, date_format)
+    end = parse_date(end_str, date_format)
+    with phase("load"):
+        data = load_dated(filepath, start, end)
+
+    for date_str, e, entry in iterate_dated_dict(data, start=start, end=end):
         pprint(entry)
         input()
 
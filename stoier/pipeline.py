@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import click
+import logging
+
+from datetime import datetime
+from pathlib import Path
+from stoier import serialize
+from stoier.account import AccountedBook
+from stoier.clean import CleanBook
+from stoier.csvtoyaml import Book, add_csv_files, get_header, get_trigger
+from stoier.deduplicate import UniqueBook
+from stoier.log import setup_logging
+from stoier.report import Report, copy_static_files, get_previous_report
+from stoier.retain import retain
+from stoier.store import PARTITIONS
+from stoier.timings import phase, timed
+from stoier.utils import (
+    get_date,
+    get_latest_file,
+    load_dated,
+    make_dated_dir,
+    set_latest_dir
+)
+from stoier.validate import ValidatedBook
+
+logger = logging.getLogger(__name__)
+
+
+def get_stage_path(out_dir, stage, now=None):
+    out_path = Path(out_dir) / stage
+    if now is not None:
+        return make_dated_dir(out_path, now)
+    if not out_path.is_dir():
+        out_path.mkdir(parents=True)
+    return out_path
+
+
+@click.group()
+def stoier():
+    pass
+
+
+@stoier.command()
+@timed
+@click.option("-d", "--debug", is_flag=True, default=False)
+@click.option("-v", "--verbose", is_flag=True, default=False)
+@click.option("-s", "--skip", default=0)
+@click.option("-r", "--reverse", "reverse", is_flag=True, default=False)
+@click.option("-h", "--header", "header_str", default=None)
+@click.option("-t", "--trigger", "trigger_str", default=None)
+@click.option("-e", "--encoding", default="iso-8859-1")
+@click.option(
+    "-j", "--jobs", default=1,
+    help="Number of processes used to parse files, write accounts and render pages"
+)
+@click.option("--amount_col", "amount_col", default="amount")
+@click.option("--balance_col", "balance_col", default="balance")
+@click.option("--details_col", "details_col", default="details")
+@click.option("--sender_col", "sender_col", default="sender")
+@click.option("--date_col", "date_col", default="date_1")
+@click.option("-f", "--format", "date_format", default="%d.%m.%Y")
+@click.option("--start", "start_str", default=None)
+@click.option("--end", "end_str", default=None)
+@click.option("-n", "--net_account_name", "net_account_name", default="earnings")
+@click.option("--accounts", "acct_filename", default=None)
+@click.option(
+    "--assignments", "assign_filename", default=None,
+    help="Use this (edited) 04_valid_bookings file instead of the validated bookings"
+)
+@click.option("--vat", "vat_amount", default=19)
+@click.option("--csv_header", "csv_header_str", default=None)
+@click.option(
+    "--no-gross-csv", help="Exclude gross accounts from csv export", is_flag=True, default=False
+)
+@click.option("--invoices_dir", "invoices_path", default=None, type=Path)
+@click.option(
+    "--page-size", type=click.IntRange(min=1), default=None,
+    help="Split account pages into pages with at most this many bookings"
+)
+@click.option(
+    "-w", "--write-intermediates", "write_intermediates", is_flag=True, default=False,
+    help="Also write the output of each stage (01_bookings ... 05_accounts)"
+)
+@click.option(
+    "--output-format", "fmt", type=click.Choice(serialize.FORMATS.keys()), default="yaml"
+)
+@click.option(
+    "--partition", type=click.Choice(PARTITIONS.keys()), default=None,
+    help="Write a store partitioned by month or year instead of a single file"
+)
+@click.argument("out_dir")
+@click.argument("csv_filenames", nargs=-1)
+def run(
+    debug,
+    verbose,
+    skip,
+    reverse,
+    header_str,
+    trigger_str,
+    encoding,
+    jobs,
+    amount_col,
+    balance_col,
+    details_col,
+    sender_col,
+    date_col,
+    date_format,
+    start_str,
+    end_str,
+    net_account_name,
+    acct_filename,
+    assign_filename,
+    vat_amount,
+    csv_header_str,
+    no_gross_csv,
+    invoices_path,
+    page_size,
+    write_intermediates,
+    fmt,
+    partition,
+    out_dir,
+    csv_filenames
+):
+    """
+    Runs 00_csv_to_yml, 01_clean, 02_deduplicate, 03_validate, 05_account and 06_report
+    in one process. The data is passed from one stage to the next in memory.
+    """
+    setup_logging(debug, verbose)
+    now = datetime.now()
+
+    # Each stage changes the entries of the previous stage in place, so the intermediate
+    # files have to be written before the next stage runs.
+    with phase("csv_to_yml"):
+        book = Book()
+        add_csv_files(
+            book, csv_filenames, encoding, skip, get_trigger(trigger_str),
+            get_header(header_str), jobs
+        )
+        if reverse:
+            book.entries.reverse()
+        if write_intermediates:
+            book.to_file(get_stage_path(out_dir, "01_bookings"), fmt=fmt)
+
+    with phase("clean"):
+        c_book = CleanBook()
+        c_book.add_entries(book.entries, amount_col, balance_col, details_col)
+        if write_intermediates:
+            c_book.to_file(get_stage_path(out_dir, "02_clean_bookings"), fmt)
+
+    with phase("deduplicate"):
+        u_book = UniqueBook()
+        u_book.add_entries(
+            c_book.entries,
+            get_date(start_str, date_format),
+            get_date(end_str, date_format),
+            date_col,
+            date_format
+        )
+        if write_intermediates:
+            out_path = get_stage_path(out_dir, "03_unique_bookings")
+            u_book.to_file(out_path, date=now, fmt=fmt, partition=partition)
+            u_book.save_accounts(out_path, date=now)
+        data = dict(u_book.entries)
+
+    with phase("validate"):
+        if assign_filename:
+            assign_filepath = get_latest_file(assign_filename)
+            logger.debug(f"Using {assign_filepath} as assign file.")
+            assign_data = load_dated(assign_filepath)
+        else:
+            if acct_filename:
+                acct_filepath = get_latest_file(
+                    acct_filename,
+                    glob_str="accounts_*",
+                    date_extract_fct=lambda f: serialize.get_stem(f)[9:]
+                )
+                logger.debug(f"Using {acct_filepath} as accounts file.")
+                with serialize.open_file(acct_filepath) as acct_file:
+                    accounts = serialize.safe_load(acct_file)
+            else:
+                accounts = None
+            v_book = ValidatedBook(accounts)
+            v_book.add_entries(data, amount_col, balance_col, sender_col, net_account_name)
+            if write_intermediates:
+                v_book.to_file(get_stage_path(out_dir, "04_valid_bookings"), fmt, partition)
+            assign_data = dict(v_book.entries)
+
+    with phase("account"):
+        if csv_header_str:
+            csv_header = csv_header_str.split(":")
+        else:
+            csv_header = None
+        a_book = AccountedBook(vat_amount, amount_col, header=csv_header)
+        a_book.add_entries(data, assign_data)
+        accounts_path = get_stage_path(out_dir, "05_accounts", now)
+        if write_intermediates:
+            a_book.save_accounts(accounts_path, now, fmt, jobs)
+        a_book.to_csv(accounts_path, now, no_gross_csv)
+        set_latest_dir(accounts_path, now)
+
+    with phase("report"):
+        report = Report(page_size)
+        report.add_entries(data)
+        for account in a_book.accounts.values():
+            report.add_account(account.serialize())
+        if invoices_path:
+            report.add_invoices_from_dir(invoices_path)
+        previous_path = get_previous_report(out_dir)
+        report_path = get_stage_path(out_dir, "06_report", now)
+        report.to_files(report_path, jobs, previous_path)
+        copy_static_files(report_path, previous_path)
+        set_latest_dir(report_path, now)
+    logger.info(f"Report written to {report_path}")
+
+
+stoier.add_command(retain)
+
+
+if __name__ == "__main__":
+    stoier()
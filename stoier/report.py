@@ -1,22 +1,41 @@
 #!/usr/bin/env python3
 
 import click
-import http.server
+import filecmp
+import hashlib
 import logging
+import os
 import shutil
-import socketserver
-import yaml
+import threading
+import time
 
 from collections import OrderedDict, defaultdict
 from datetime import datetime
+from itertools import islice, repeat
 from pathlib import Path
+from stoier import serialize
+from stoier.account import get_bookings_digest, get_summary
 from stoier.log import setup_logging
-from stoier.utils import iterate_dated_dict, get_latest_file, render_html
+from stoier.serve import GZIP_SUFFIX, serve, write_compressed
+from stoier.timings import phase, timed
+from stoier.utils import (
+    iterate_dated_dict,
+    get_latest_file,
+    load_dated,
+    make_dated_dir,
+    map_jobs,
+    render_html,
+    render_template,
+    set_latest_dir,
+    NotADateError,
+    NotADirError
+)
 
 
 logger = logging.getLogger(__name__)
 
 STATIC_DIR = Path(__file__).parent / "static"
+MANIFEST_NAME = "manifest.yml"
 PORT = 8000
 
 
@@ -28,31 +47,66 @@ class Report():
         "index": templates_path / "index.html"
     }
 
-    def __init__(self):
+    def __init__(self, page_size=None):
+        """If page_size is given, account pages show at most page_size bookings each."""
+        self.page_size = page_size
         self.entries = OrderedDict()
         self.accounts = dict()
+        self.account_files = dict()
         self.invoices = defaultdict(list)
 
     def sort_accounts(self):
         self.accounts = OrderedDict(sorted(self.accounts.items()))
 
     def add_entries_from_yaml(self, yaml_file):
-        data = yaml.load(yaml_file, Loader=yaml.Loader)
-        dates = [datetime.strptime(date, "%Y-%m-%d") for date in data.keys()]
-        dates.sort()
+        self.add_entries(serialize.load(yaml_file))
+
+    def add_entries(self, data):
         for date, e, entry in iterate_dated_dict(data):
             if date not in self.entries.keys():
                 self.entries[date] = []
             self.entries[date].append(entry)
 
     def add_account_from_yaml(self, yaml_file):
-        account_data = yaml.load(yaml_file, Loader=yaml.Loader)
+        documents = serialize.load_all(yaml_file)
+        account_data = next(documents)
+        if "bookings" not in account_data:
+            account_data["bookings"] = next(documents)
+        self.add_account(account_data)
+
+    def add_account_from_file(self, filepath):
+        """
+        Adds the account in filepath. Only the header is read, the bookings are read when
+        a page is rendered. Files without a header (one document with name, type and
+        bookings) are read completely.
+        """
+        account_data = next(serialize.load_all_file(filepath))
+        if "bookings" not in account_data:
+            account_data["bookings"] = None
+            self.account_files[str(account_data["name"])] = filepath
+        self.add_account(account_data)
+
+    def add_account(self, account_data):
         account_name = str(account_data['name'])
         logger.info(f"Add account {account_name}")
+        if "summary" not in account_data:
+            bookings = account_data["bookings"]
+            account_data["summary"] = get_summary(
+                [b[f"{account_data['type']}_amount"] for b in bookings],
+                digest=get_bookings_digest(bookings)
+            )
         self.accounts[account_name] = account_data
 
+    def get_bookings(self, account_name):
+        bookings = self.accounts[account_name]["bookings"]
+        if bookings is None:
+            filepath = self.account_files[account_name]
+            logger.debug(f"Reading bookings from {filepath}")
+            bookings = next(islice(serialize.load_all_file(filepath), 1, None))
+        return bookings
+
     def add_invoice(self, account, invoice_file):
-        invoice = yaml.load(invoice_file, Loader=yaml.Loader)
+        invoice = serialize.load(invoice_file)
         self.invoices[account].append(invoice)
 
     def get_index_context(self):
@@ -63,28 +117,19 @@ class Report():
             "net": []
         }
         for name, account in self.accounts.items():
-            if account["type"] == "gross":
-                index_accounts["gross"].append({
+            summary = account["summary"]
+            if account["type"] in ("gross", "net"):
+                index_accounts[account["type"]].append({
                     "name": name,
-                    "total": sum([t["gross_amount"] for t in account["bookings"]]),
-                    "href": f"{name}.html"
-                })
-            elif account["type"] == "net":
-                index_accounts["net"].append({
-                    "name": name,
-                    "total": sum([t["net_amount"] for t in account["bookings"]]),
+                    "total": summary["total"],
                     "href": f"{name}.html"
                 })
             elif account["type"] == "vat":
                 index_accounts["vat"].append({
                     "name": name,
-                    "total": sum([t["vat_amount"] for t in account["bookings"]]),
-                    "total_in": sum(
-                        [t["vat_amount"] for t in account["bookings"] if t["vat_amount"] > 0]
-                    ),
-                    "total_out": sum(
-                        [t["vat_amount"] for t in account["bookings"] if t["vat_amount"] < 0]
-                    ),
+                    "total": summary["total"],
+                    "total_in": summary["total_in"],
+                    "total_out": summary["total_out"],
                     "href": f"{name}.html"
                 })
             else:
@@ -94,8 +139,25 @@ class Report():
         }
         return context
 
-    def get_account_context(self, account_name):
-        logger.debug(f"Get context for account {account_name}")
+    def get_page_count(self, account_name):
+        count = self.accounts[account_name]["summary"]["count"]
+        if not self.page_size or count <= self.page_size:
+            return 1
+        return -(-count // self.page_size)
+
+    @staticmethod
+    def get_page_name(account_name, page=1):
+        if page == 1:
+            return f"{account_name}.html"
+        return f"{account_name}.{page}.html"
+
+    def get_page_names(self, account_name):
+        for page in range(1, self.get_page_count(account_name) + 1):
+            yield page, self.get_page_name(account_name, page)
+
+    def get_page_context(self, account_name, page=1):
+        """Returns the context of an account page without the bookings."""
+        logger.debug(f"Get context for account {account_name}, page {page}")
         accounts = list(self.accounts.keys())
         try:
             previous_account = accounts[accounts.index(account_name)-1] + ".html"
@@ -105,96 +167,370 @@ class Report():
             next_account = accounts[accounts.index(account_name)+1] + ".html"
         except Exception:
             next_account = "#"
+        pages = self.get_page_count(account_name)
         context = {
             "previous": previous_account,
             "next": next_account,
             "account_name": account_name,
-            "bookings": self.accounts[account_name]["bookings"],
+            "page": page,
+            "pages": pages,
+            "previous_page": self.get_page_name(account_name, page - 1) if page > 1 else None,
+            "next_page": self.get_page_name(account_name, page + 1) if page < pages else None,
             "invoices": self.invoices[account_name]
         }
         return context
 
-    def to_files(self, out_path):
+    def get_account_contexts(self, account_name, pages):
+        """Yields the contexts of the given pages of an account, the bookings are read once."""
+        bookings = self.get_bookings(account_name)
+        total = sum([b["amount"] for b in bookings])
+        for page in pages:
+            context = self.get_page_context(account_name, page)
+            if self.page_size:
+                start = (page - 1) * self.page_size
+                context["bookings"] = bookings[start:start + self.page_size]
+            else:
+                context["bookings"] = bookings
+            context["total"] = total
+            yield context
+
+    def get_account_context(self, account_name, page=1):
+        return next(self.get_account_contexts(account_name, [page]))
+
+    def get_page_digest(self, account_name, page, template_digest):
+        """Returns a digest of the context of a page without reading the bookings."""
+        context = self.get_page_context(account_name, page)
+        context["bookings"] = self.accounts[account_name]["summary"]["digest"]
+        context["page_size"] = self.page_size
+        return get_context_digest(context, template_digest)
+
+    def to_files(self, out_path, jobs=1, previous_path=None):
+        """
+        Renders all pages. If jobs > 1, the account pages are rendered in parallel.
+
+        A manifest with a digest of the context of each account page is written. The
+        bookings are part of the digest through the digest in the account summary, so
+        they are only read for accounts with pages which are rendered. If the path of a
+        previous report is given, pages with an unchanged digest are linked from there
+        instead of being rendered again.
+        """
         self.sort_accounts()
-        for name, account in self.accounts.items():
-            logging.info(f"Rendering account {name}")
-            render_html(
-                self.get_account_context(name),
-                self.templates["account"],
-                out_path / f"{name}.html"
-            )
+        template_digest = get_file_digest(self.templates["account"])
+        previous_manifest = load_manifest(previous_path) if previous_path else {}
+        manifest = dict()
+        pages = defaultdict(list)
+        for name in self.accounts.keys():
+            for page, page_name in self.get_page_names(name):
+                manifest[page_name] = self.get_page_digest(name, page, template_digest)
+                if (
+                        previous_manifest.get(page_name) == manifest[page_name]
+                        and link_file(previous_path / page_name, out_path / page_name)
+                ):
+                    logger.debug(f"Reusing unchanged page {page_name}")
+                    continue
+                pages[name].append(page)
+        logger.info(
+            f"Rendering {sum(map(len, pages.values()))} of {len(manifest)} account pages"
+        )
+
+        contexts = (
+            context
+            for name, account_pages in pages.items()
+            for context in self.get_account_contexts(name, account_pages)
+        )
+        for name in map_jobs(
+                self.render_account_page,
+                contexts,
+                repeat(self.templates["account"]),
+                repeat(out_path),
+                jobs=jobs
+        ):
+            logger.info(f"Rendered account {name}")
         render_html(
             self.get_index_context(),
             self.templates["index"],
             out_path / "index.html"
         )
+        serialize.dump_file(manifest, out_path / MANIFEST_NAME)
+
+    @staticmethod
+    def render_account_page(context, template_filepath, out_path):
+        name = context["account_name"]
+        page_name = Report.get_page_name(name, context["page"])
+        render_html(context, template_filepath, out_path / page_name)
+        return name if context["pages"] == 1 else f"{name} ({context['page']}/{context['pages']})"
 
     @classmethod
-    def from_dirs(cls, bookings_dir, accounts_dir, invoices_path=None):
-        report = cls()
+    def from_dirs(cls, bookings_dir, accounts_dir, invoices_path=None, page_size=None):
+        report = cls(page_size)
 
         bookings_path = get_latest_file(bookings_dir)
         logger.debug(f"Using {bookings_path} for bookings")
-        with open(bookings_path) as yaml_file:
-            report.add_entries_from_yaml(yaml_file)
+        report.add_entries(load_dated(bookings_path))
 
         accounts_path = get_latest_file(
-            accounts_dir, glob_str="*", ext="", date_extract_fct=lambda f: f.name)
+            accounts_dir, suffixes=None, date_extract_fct=lambda f: f.name)
         logger.debug(f"Using {accounts_path} for accounts")
-        for account_filepath in Path(accounts_path).glob("*.yml"):
+        for account_filepath in Path(accounts_path).glob("*"):
+            if serialize.get_suffix(account_filepath) not in serialize.KNOWN_SUFFIXES:
+                continue
             logger.debug(f"Reading {account_filepath}")
-            with open(account_filepath) as account_file:
-                report.add_account_from_yaml(account_file)
+            report.add_account_from_file(account_filepath)
 
         if invoices_path:
-            logger.debug(f"Using {invoices_path} for invoices")
-            for customer_dir in invoices_path.glob("*"):
-                for invoice_path in customer_dir.glob("*.yaml"):
-                    logger.info(f"Adding invoice {invoice_path.name}")
-                    with open(invoice_path) as invoice_file:
-                        report.add_invoice(customer_dir.name, invoice_file)
+            report.add_invoices_from_dir(invoices_path)
         return report
 
+    def add_invoices_from_dir(self, invoices_path):
+        logger.debug(f"Using {invoices_path} for invoices")
+        for customer_dir in invoices_path.glob("*"):
+            for invoice_path in customer_dir.glob("*.yaml"):
+                logger.info(f"Adding invoice {invoice_path.name}")
+                with open(invoice_path) as invoice_file:
+                    self.add_invoice(customer_dir.name, invoice_file)
+
+
+class LiveReport():
+    """
+    Keeps a report in memory and renders its pages on request. Before a page is rendered,
+    the report is rebuilt if bookings or accounts are new or changed (checked at most once every
+    check_interval seconds). Rendered pages are kept as long as their digest is unchanged.
+    """
+
+    check_interval = 1.0
+
+    def __init__(self, bookings_dir, accounts_dir, invoices_path=None, page_size=None):
+        self.bookings_dir = bookings_dir
+        self.accounts_dir = accounts_dir
+        self.invoices_path = invoices_path
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.report = None
+        self.sources = None
+        self.checked = None
+        self.page_names = dict()
+        self.pages = dict()
+        self.update()
+
+    def get_sources(self):
+        """
+        Returns the latest bookings and accounts together with fingerprints of their
+        contents, so a directory is read again while files are added to it.
+        """
+        bookings_path = get_latest_file(self.bookings_dir)
+        accounts_path = get_latest_file(
+            self.accounts_dir, suffixes=None, date_extract_fct=lambda f: f.name
+        )
+        return (
+            bookings_path,
+            get_path_fingerprint(bookings_path),
+            accounts_path,
+            get_path_fingerprint(accounts_path)
+        )
+
+    def update(self):
+        """Rebuilds the report, if newer files exist."""
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        sources = self.get_sources()
+        if sources == self.sources:
+            return
+        logger.info(f"Reading report from {sources[0]} and {sources[2]}")
+        report = Report.from_dirs(
+            self.bookings_dir, self.accounts_dir, self.invoices_path, self.page_size
+        )
+        report.sort_accounts()
+        self.report = report
+        self.sources = sources
+        self.page_names = {
+            page_name: (name, page)
+            for name in report.accounts.keys()
+            for page, page_name in report.get_page_names(name)
+        }
+        # Only keep the rendered pages which did not change
+        template_digest = get_file_digest(report.templates["account"])
+        digests = {
+            report.get_page_digest(name, page, template_digest)
+            for name, page in self.page_names.values()
+        }
+        digests.add(self.get_index_digest(report))
+        self.pages = {digest: html for digest, html in self.pages.items() if digest in digests}
+
+    @staticmethod
+    def get_index_digest(report, context=None):
+        if context is None:
+            context = report.get_index_context()
+        return get_context_digest(context, get_file_digest(report.templates["index"]))
+
+    def get_page(self, page_name):
+        """Returns the html of page_name or None, if the report has no such page."""
+        with self.lock:
+            try:
+                self.update()
+            except (NotADateError, NotADirError, OSError, *serialize.LOAD_ERRORS) as e:
+                # Keep serving the last report, e.g. while new files are written
+                logger.warning(f"Could not update report: {e}")
+            report = self.report
+            page_names = self.page_names
+
+        if page_name == "index.html":
+            context = report.get_index_context()
+            template = report.templates["index"]
+            digest = self.get_index_digest(report, context)
+        elif page_name in page_names:
+            name, page = page_names[page_name]
+            template = report.templates["account"]
+            digest = report.get_page_digest(name, page, get_file_digest(template))
+            context = None
+        else:
+            return None
+
+        if digest not in self.pages:
+            if context is None:
+                context = report.get_account_context(name, page)
+            logger.info(f"Rendering {page_name}")
+            self.pages[digest] = render_template(context, template)
+        return self.pages[digest]
+
+
+def get_path_fingerprint(path):
+    """Returns mtime and size of a file or of a directory and all files in it."""
+    stat = path.stat()
+    fingerprint = [(path.name, stat.st_mtime_ns, stat.st_size)]
+    if path.is_dir():
+        for child in sorted(path.iterdir()):
+            stat = child.stat()
+            fingerprint.append((child.name, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+def get_file_digest(filepath):
+    with open(filepath, "rb") as infile:
+        return hashlib.sha256(infile.read()).hexdigest()
+
+
+def get_context_digest(context, template_digest):
+    context_hash = hashlib.sha256(template_digest.encode())
+    context_hash.update(repr(context).encode())
+    return context_hash.hexdigest()
+
+
+def load_manifest(report_path):
+    manifest_path = report_path / MANIFEST_NAME
+    if not manifest_path.is_file():
+        return {}
+    return serialize.load_file(manifest_path)
+
+
+def link_file(src_path, dst_path):
+    """Hardlinks (or copies, if linking fails) src_path to dst_path if it exists."""
+    if not src_path.is_file():
+        return False
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copy2(src_path, dst_path)
+    return True
+
+
+def get_previous_report(out_dir):
+    """Returns the path of the latest report in out_dir or None."""
+    try:
+        return get_latest_file(
+            Path(out_dir) / "06_report", suffixes=None, date_extract_fct=lambda f: f.name
+        )
+    except (NotADateError, NotADirError):
+        return None
+
+
+def copy_static_files(out_path, previous_path=None):
+    """
+    Copies the static files and precompressed copies of them (see stoier.serve) to the
+    report. Files which are unchanged in the previous report are linked from there.
+    """
+    logger.debug("Copying static files")
+    static_path = out_path / "static"
+    static_path.mkdir()
+    for static_file in STATIC_DIR.glob("*"):
+        previous_file = previous_path / "static" / static_file.name if previous_path else None
+        if (
+                previous_file is not None
+                and previous_file.is_file()
+                and filecmp.cmp(static_file, previous_file)
+                and link_file(previous_file, static_path / static_file.name)
+                and link_file(
+                    previous_file.with_name(previous_file.name + GZIP_SUFFIX),
+                    static_path / (static_file.name + GZIP_SUFFIX)
+                )
+        ):
+            logger.debug(f"Linked {previous_file}")
+            continue
+        logger.debug(f"Copying {static_file}")
+        shutil.copy2(static_file, static_path / static_file.name)
+        write_compressed(static_path / static_file.name)
+
 
 @click.command()
+@timed
 @click.option("-d", "--debug", is_flag=True, default=False)
 @click.option("-v", "--verbose", is_flag=True, default=False)
 @click.option("-p", "--port", default=PORT)
-@click.option("--serve", "serve", is_flag=True, default=False)
+@click.option("--serve", "serve_report", is_flag=True, default=False)
+@click.option(
+    "--live", is_flag=True, default=False,
+    help="Serve pages rendered on request from the latest files instead of writing a report"
+)
 @click.option("--invoices_dir", "invoices_path", default=None, type=Path)
+@click.option("-j", "--jobs", help="Number of processes used to render pages", default=1)
+@click.option(
+    "--full", help="Render all pages, even if they are unchanged since the last report",
+    is_flag=True, default=False
+)
+@click.option(
+    "--page-size", type=click.IntRange(min=1), default=None,
+    help="Split account pages into pages with at most this many bookings"
+)
 @click.argument("out_dir")
 @click.argument("bookings_dir")
 @click.argument("accounts_dir")
 def report(
-    debug, verbose, port, serve, out_dir, invoices_path, bookings_dir, accounts_dir,
+    debug,
+    verbose,
+    port,
+    serve_report,
+    live,
+    jobs,
+    full,
+    page_size,
+    out_dir,
+    invoices_path,
+    bookings_dir,
+    accounts_dir,
 ):
     setup_logging(debug, verbose)
 
-    report = Report.from_dirs(bookings_dir, accounts_dir, invoices_path)
+    if live:
+        live_report = LiveReport(bookings_dir, accounts_dir, invoices_path, page_size)
+        serve(STATIC_DIR, port, live_report.get_page)
+        return
 
-    now = datetime.now()
-    out_path = Path(out_dir) / "06_report" / now.isoformat()
-    if not out_path.is_dir():
-        out_path.mkdir(parents=True)
-    report.to_files(out_path)
+    with phase("load"):
+        report = Report.from_dirs(bookings_dir, accounts_dir, invoices_path, page_size)
 
-    logger.debug("Copying static files")
-    static_path = out_path / "static"
-    static_path.mkdir()
-    for static_file in STATIC_DIR.glob("*"):
-        logger.debug(f"Copying {static_file}")
-        shutil.copy(static_file, static_path / static_file.name)
+    previous_path = None if full else get_previous_report(out_dir)
+    now = datetime.now()
+    out_path = make_dated_dir(Path(out_dir) / "06_report", now)
+    with phase("save"):
+        report.to_files(out_path, jobs, previous_path)
+        copy_static_files(out_path, previous_path)
+        set_latest_dir(out_path, now)
 
     logger.info(f"Report written to {out_path}")
 
-    if serve:
-        class Handler(http.server.SimpleHTTPRequestHandler):
-            def __init__(self, *args, **kwargs):
-                super().__init__(*args, directory=out_path, **kwargs)
-
-        with socketserver.TCPServer(("", port), Handler) as httpd:
-            logging.info(f"Serving at http://localhost:{port}/")
-            httpd.serve_forever()
+    if serve_report:
+        serve(out_path, port)
 
 
 if __name__ == "__main__":
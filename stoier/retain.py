@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Retention of the timestamped outputs of the stages.
+
+The outputs in a stage directory are grouped by prefix (e.g. "", "accounts_", "digests_")
+and date; all files and directories with the same prefix and date are one generation. Only
+the last generations of each prefix are kept, identical files are replaced by hardlinks
+and old generations can be compressed. The latest generation of each prefix (the one
+get_latest_file picks) is never changed.
+"""
+
+import click
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from stoier.log import setup_logging
+from stoier.serialize import COMPRESSION_SUFFIXES, get_suffix
+from stoier.timings import timed
+from stoier.utils import DATA_SUFFIXES, LATEST_NAME, get_latest_from_manifest, is_latest_fresh
+
+logger = logging.getLogger(__name__)
+
+GENERATION_RE = re.compile(
+    r"^(?P<prefix>.*?)(?P<date>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d{1,6})?)(?P<suffix>.*)$"
+)
+STAGE_RE = re.compile(r"^\d\d_")
+CHUNK_SIZE = 1 << 20
+
+
+def get_generations(stage_path):
+    """Returns {prefix: {date: [paths]}} of the timestamped outputs in stage_path."""
+    generations = defaultdict(lambda: defaultdict(list))
+    for path in stage_path.iterdir():
+        match = GENERATION_RE.match(path.name)
+        if not match:
+            continue
+        try:
+            date = datetime.fromisoformat(match["date"])
+        except ValueError:
+            continue
+        generations[match["prefix"]][date].append(path)
+    return generations
+
+
+def iter_files(paths):
+    for path in paths:
+        if path.is_dir() and not path.is_symlink():
+            yield from (p for p in sorted(path.rglob("*")) if p.is_file() and not p.is_symlink())
+        elif path.is_file():
+            yield path
+
+
+def get_file_digest(filepath):
+    file_hash = hashlib.sha256()
+    with open(filepath, "rb") as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class Retention:
+    """
+    Applies the retention to one stage directory. If dry_run is set, the actions are only
+    logged.
+    """
+
+    def __init__(self, stage_path, keep=5, compress=False, dry_run=False):
+        self.stage_path = stage_path
+        self.keep = max(keep, 1)
+        self.compress = compress
+        self.dry_run = dry_run
+        self.removed = 0
+        self.linked = 0
+        self.compressed = 0
+        self.saved_bytes = 0
+
+    def split_generations(self):
+        """Returns the paths of the kept latest, the kept older and the removed generations."""
+        latest, kept, removed = [], [], []
+        for prefix, dates in get_generations(self.stage_path).items():
+            pinned = get_latest_from_manifest(self.stage_path, f"{prefix}*")
+            data_found = False
+            for i, date in enumerate(sorted(dates, reverse=True)):
+                paths = dates[date]
+                # The newest generation with data or directories is what get_latest_file
+                # picks, even if a newer generation only contains other files.
+                has_data = any(p.is_dir() or get_suffix(p) in DATA_SUFFIXES for p in paths)
+                if i == 0 or pinned in paths or (has_data and not data_found):
+                    data_found = data_found or has_data
+                    latest.extend(paths)
+                elif i < self.keep:
+                    kept.extend(paths)
+                else:
+                    removed.extend(paths)
+        return latest, kept, removed
+
+    def remove(self, paths):
+        for path in paths:
+            logger.info(f"{'Would remove' if self.dry_run else 'Removing'} {path}")
+            self.saved_bytes += sum(
+                f.stat().st_size for f in iter_files([path]) if f.stat().st_nlink == 1
+            )
+            self.removed += 1
+            if self.dry_run:
+                continue
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+    def deduplicate(self, latest, kept):
+        """Replaces identical files by hardlinks. Files of latest are never replaced."""
+        protected = set(iter_files(latest))
+        by_size = defaultdict(list)
+        for path in iter_files(latest + kept):
+            if path.name != LATEST_NAME:
+                by_size[path.stat().st_size].append(path)
+        for size, paths in by_size.items():
+            if size == 0 or len(paths) < 2:
+                continue
+            by_digest = defaultdict(list)
+            for path in paths:
+                by_digest[get_file_digest(path)].append(path)
+            for same_paths in by_digest.values():
+                # Link to a protected file if possible, otherwise to the newest file
+                same_paths.sort(key=lambda p: (p in protected, p.stat().st_mtime_ns))
+                target = same_paths[-1]
+                target_stat = target.stat()
+                for path in same_paths[:-1]:
+                    if path in protected or path.stat().st_ino == target_stat.st_ino:
+                        continue
+                    self.link(target, path)
+
+    def link(self, target, path):
+        logger.info(f"{'Would link' if self.dry_run else 'Linking'} {path} to {target}")
+        self.linked += 1
+        if path.stat().st_nlink == 1:
+            self.saved_bytes += path.stat().st_size
+        if self.dry_run:
+            return
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        os.link(target, tmp_path)
+        os.replace(tmp_path, path)
+
+    def compress_files(self, kept):
+        """Compresses the files of the kept older generations, which are not hardlinked."""
+        for path in iter_files(kept):
+            stat = path.stat()
+            if path.suffix in COMPRESSION_SUFFIXES or path.name == LATEST_NAME or stat.st_nlink > 1:
+                continue
+            logger.info(f"{'Would compress' if self.dry_run else 'Compressing'} {path}")
+            self.compressed += 1
+            if self.dry_run:
+                continue
+            gz_path = path.with_name(f"{path.name}.gz")
+            with open(path, "rb") as infile, gzip.open(gz_path, "wb") as outfile:
+                shutil.copyfileobj(infile, outfile, CHUNK_SIZE)
+            gz_size = gz_path.stat().st_size
+            if gz_size >= stat.st_size:
+                # Small files do not get smaller
+                gz_path.unlink()
+                continue
+            shutil.copystat(path, gz_path)
+            self.saved_bytes += stat.st_size - gz_size
+            path.unlink()
+
+    def apply(self):
+        fresh = is_latest_fresh(self.stage_path)
+        latest, kept, removed = self.split_generations()
+        self.remove(removed)
+        self.deduplicate(latest, kept)
+        if self.compress:
+            self.compress_files(kept)
+        # Nothing has been added, so the manifest is still up to date
+        if fresh and not self.dry_run:
+            os.utime(self.stage_path / LATEST_NAME)
+        logger.info(
+            f"{self.stage_path}: removed {self.removed}, linked {self.linked}, "
+            f"compressed {self.compressed} ({self.saved_bytes} bytes)"
+        )
+        return self.saved_bytes
+
+
+@click.command()
+@timed
+@click.option("-d", "--debug", is_flag=True, default=False)
+@click.option("-v", "--verbose", is_flag=True, default=False)
+@click.option("-k", "--keep", default=5, help="Number of generations kept per stage and prefix")
+@click.option(
+    "-c", "--compress", is_flag=True, default=False,
+    help="Compress the files of kept generations except the latest"
+)
+@click.option(
+    "-n", "--dry-run", "dry_run", is_flag=True, default=False,
+    help="Only show what would be done"
+)
+@click.option(
+    "-s", "--stage", "stages", multiple=True,
+    help="Only these stage directories (default: all directories 00_... in OUT_DIR)"
+)
+@click.argument("out_dir", type=Path)
+def retain(debug, verbose, keep, compress, dry_run, stages, out_dir):
+    """Removes, deduplicates and compresses old outputs of the stages in OUT_DIR."""
+    setup_logging(debug, verbose)
+    if stages:
+        stage_paths = [out_dir / stage for stage in stages]
+    else:
+        stage_paths = sorted(
+            p for p in out_dir.iterdir() if p.is_dir() and STAGE_RE.match(p.name)
+        )
+    saved_bytes = 0
+    for stage_path in stage_paths:
+        saved_bytes += Retention(stage_path, keep, compress, dry_run).apply()
+    print(f"{'Would save' if dry_run else 'Saved'} {saved_bytes} bytes")
+
+
+if __name__ == "__main__":
+    retain()
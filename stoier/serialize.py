@@ -0,0 +1,164 @@
+"""
+Central (de)serialization of the files written and read by the stages.
+
+The libyaml based loaders and dumpers are used if PyYAML was built with libyaml, otherwise
+the pure Python implementations are used. Both read the same documents.
+
+Intermediate files can also be written as pickle (protocol 5), which keeps Decimal and
+datetime objects and is much faster to read. The format of a file is marked by its suffix.
+
+Both formats can be compressed with gzip ("yaml.gz" -> ".yml.gz") or, if zstandard is
+installed, with zstd ("yaml.zst" -> ".yml.zst"). Compressed files are read transparently.
+"""
+
+import gzip
+import pickle
+import yaml
+
+from functools import partial
+from pathlib import Path
+
+try:
+    from yaml import CDumper as Dumper, CLoader as Loader, CSafeLoader as SafeLoader
+except ImportError:  # PyYAML without libyaml
+    from yaml import Dumper, Loader, SafeLoader
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+BASE_FORMATS = {
+    "yaml": ".yml",
+    "pickle": ".pickle"
+}
+# Suffix of the compression -> function opening a file like open
+COMPRESSIONS = {
+    ".gz": partial(gzip.open, compresslevel=6)
+}
+if zstandard is not None:
+    COMPRESSIONS[".zst"] = zstandard.open
+COMPRESSION_SUFFIXES = (".gz", ".zst")
+FORMATS = dict(BASE_FORMATS)
+for fmt, suffix in BASE_FORMATS.items():
+    for compression_suffix in COMPRESSIONS:
+        FORMATS[f"{fmt}{compression_suffix}"] = f"{suffix}{compression_suffix}"
+SUFFIXES = {suffix: fmt for fmt, suffix in FORMATS.items()}
+# Suffixes of all formats, also with compressions which are not installed. Files are found
+# by them, so the latest file is not skipped and reading it raises UnknownFormatError.
+KNOWN_SUFFIXES = tuple(
+    f"{suffix}{compression_suffix}"
+    for suffix in BASE_FORMATS.values()
+    for compression_suffix in ("", *COMPRESSION_SUFFIXES)
+)
+PICKLE_PROTOCOL = 5
+# Raised when reading incomplete or broken files
+LOAD_ERRORS = (yaml.YAMLError, pickle.UnpicklingError, EOFError)
+
+
+class UnknownFormatError(Exception):
+    pass
+
+
+def load(stream):
+    """Loads a document written by dump (incl. python tags like Decimal)."""
+    return yaml.load(stream, Loader=Loader)
+
+
+def safe_load(stream):
+    """Loads a document which has been written by hand, e.g. mappings or afa files."""
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump(obj, stream=None):
+    """Dumps obj to stream. If stream is None, the document is returned as str."""
+    return yaml.dump(obj, stream, Dumper=Dumper)
+
+
+def load_all(stream):
+    """Yields the documents of a stream one by one."""
+    yield from yaml.load_all(stream, Loader=Loader)
+
+
+def get_suffix(filepath):
+    """Returns the suffix of filepath incl. the suffix of its compression (".yml.gz")."""
+    suffixes = Path(filepath).suffixes
+    if len(suffixes) > 1 and suffixes[-1] in COMPRESSION_SUFFIXES:
+        return "".join(suffixes[-2:])
+    return suffixes[-1] if suffixes else ""
+
+
+def get_stem(filepath):
+    """Returns the name of filepath without its suffix (see get_suffix)."""
+    name = Path(filepath).name
+    return name[:len(name) - len(get_suffix(filepath))]
+
+
+def get_format(filepath):
+    """Returns the name of the format of filepath, determined by its suffix."""
+    suffix = get_suffix(filepath)
+    if suffix not in SUFFIXES:
+        if suffix.endswith(COMPRESSION_SUFFIXES):
+            raise UnknownFormatError(f"Reading {filepath} requires zstandard.")
+        raise UnknownFormatError(
+            f"{filepath} has no known suffix ({', '.join(SUFFIXES.keys())})."
+        )
+    return SUFFIXES[suffix]
+
+
+def is_pickle(filepath):
+    return get_format(filepath).startswith("pickle")
+
+
+def open_file(filepath, mode="r"):
+    """Opens filepath like open, but (de)compresses it if its suffix marks a compression."""
+    open_fct = COMPRESSIONS.get(Path(filepath).suffix)
+    if open_fct is None:
+        return open(filepath, mode)
+    if "b" not in mode:
+        mode = f"{mode}t"
+    return open_fct(filepath, mode)
+
+
+def load_file(filepath):
+    if is_pickle(filepath):
+        with open_file(filepath, "rb") as infile:
+            return pickle.load(infile)
+    with open_file(filepath) as infile:
+        return load(infile)
+
+
+def dump_file(obj, filepath):
+    if is_pickle(filepath):
+        with open_file(filepath, "wb") as outfile:
+            pickle.dump(obj, outfile, protocol=PICKLE_PROTOCOL)
+    else:
+        with open_file(filepath, "w") as outfile:
+            dump(obj, outfile)
+
+
+def load_all_file(filepath):
+    """
+    Yields the documents in filepath one by one, so a header document can be read without
+    reading the following documents.
+    """
+    if is_pickle(filepath):
+        with open_file(filepath, "rb") as infile:
+            while True:
+                try:
+                    yield pickle.load(infile)
+                except EOFError:
+                    return
+    else:
+        with open_file(filepath) as infile:
+            yield from load_all(infile)
+
+
+def dump_all_file(docs, filepath):
+    if is_pickle(filepath):
+        with open_file(filepath, "wb") as outfile:
+            for doc in docs:
+                pickle.dump(doc, outfile, protocol=PICKLE_PROTOCOL)
+    else:
+        with open_file(filepath, "w") as outfile:
+            yaml.dump_all(docs, outfile, Dumper=Dumper)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Serves a report directory. Requests are handled in threads, files are sent gzip
+compressed if the client accepts it (a precompressed "<file>.gz" is used if it exists)
+and ETag/Last-Modified headers allow clients to revalidate with 304 responses.
+
+Pages can also be generated on request by a function, which returns the html of a page
+name or None (see LiveReport).
+"""
+
+import email.utils
+import gzip
+import hashlib
+import http.server
+import io
+import logging
+import os
+import posixpath
+
+from functools import lru_cache, partial
+from urllib.parse import unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+COMPRESSED_TYPES = ("text/", "application/javascript", "application/json")
+GZIP_SUFFIX = ".gz"
+
+
+@lru_cache(maxsize=64)
+def get_compressed(filepath, mtime_ns, size):
+    """Returns the gzip compressed content of filepath. mtime_ns and size are cache keys."""
+    with open(filepath, "rb") as infile:
+        return gzip.compress(infile.read())
+
+
+def write_compressed(filepath):
+    """Writes a precompressed copy "<filepath>.gz" next to filepath."""
+    with open(filepath, "rb") as infile, gzip.open(f"{filepath}{GZIP_SUFFIX}", "wb") as outfile:
+        outfile.write(infile.read())
+
+
+def get_etag(stat, encoding=None):
+    return get_etag_str(f"{stat.st_mtime_ns:x}-{stat.st_size:x}", encoding)
+
+
+def get_etag_str(etag, encoding=None):
+    if encoding:
+        etag = f"{etag}-{encoding}"
+    return f'"{etag}"'
+
+
+class ReportRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    # Function returning the html of a page name ("index.html", ...) or None
+    get_page = None
+
+    def accepts_gzip(self):
+        encodings = self.headers.get("Accept-Encoding", "")
+        return "gzip" in [e.split(";")[0].strip() for e in encodings.split(",")]
+
+    def is_not_modified(self, etag, stat=None):
+        if "If-None-Match" in self.headers:
+            etags = [e.strip() for e in self.headers["If-None-Match"].split(",")]
+            return etag in etags or "*" in etags
+        if stat is not None and "If-Modified-Since" in self.headers:
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+            except (TypeError, ValueError):
+                return False
+            return since is not None and int(stat.st_mtime) <= since.timestamp()
+        return False
+
+    def send_not_modified(self, etag):
+        self.send_response(http.HTTPStatus.NOT_MODIFIED)
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+    def send_content_headers(self, ctype, length, etag, encoding=None, mtime=None):
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(length))
+        if mtime is not None:
+            self.send_header("Last-Modified", self.date_time_string(mtime))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+
+    def send_page(self, html):
+        body = html.encode()
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        encoding = None
+        if self.accepts_gzip():
+            encoding = "gzip"
+            body = gzip.compress(body)
+        etag = get_etag_str(etag, encoding)
+        if self.is_not_modified(etag):
+            self.send_not_modified(etag)
+            return None
+        self.send_content_headers("text/html", len(body), etag, encoding)
+        return io.BytesIO(body)
+
+    def send_head(self):
+        if self.get_page is not None:
+            # Normalized first, so "static/../x" is not served from the static directory
+            page_name = posixpath.normpath(unquote(urlsplit(self.path).path)).lstrip("/")
+            if not page_name.startswith("static/"):
+                html = self.get_page(page_name or "index.html")
+                if html is None:
+                    self.send_error(http.HTTPStatus.NOT_FOUND, "Page not found")
+                    return None
+                return self.send_page(html)
+            # The directory is the static directory itself
+            self.path = f"/{page_name[len('static/'):]}"
+
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not self.path.split("?", 1)[0].endswith("/"):
+                # Let SimpleHTTPRequestHandler redirect to the path with a slash
+                return super().send_head()
+            path = os.path.join(path, "index.html")
+        if not os.path.isfile(path):
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        ctype = self.guess_type(path)
+        stat = os.stat(path)
+        encoding = None
+        body = None
+        if self.accepts_gzip():
+            gz_path = f"{path}{GZIP_SUFFIX}"
+            if os.path.isfile(gz_path) and os.stat(gz_path).st_mtime >= stat.st_mtime:
+                encoding = "gzip"
+                stat = os.stat(gz_path)
+                path = gz_path
+            elif ctype.startswith(COMPRESSED_TYPES):
+                encoding = "gzip"
+                body = get_compressed(path, stat.st_mtime_ns, stat.st_size)
+        etag = get_etag(stat, encoding)
+
+        if self.is_not_modified(etag, stat):
+            self.send_not_modified(etag)
+            return None
+
+        self.send_content_headers(
+            ctype, len(body) if body is not None else stat.st_size, etag, encoding, stat.st_mtime
+        )
+        if body is not None:
+            return io.BytesIO(body)
+        return open(path, "rb")
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+
+def serve(directory, port, get_page=None):
+    """
+    Serves directory on port until interrupted. If get_page is given, all pages except
+    the static files ("static/...") are generated by get_page and directory has to be the
+    directory of the static files.
+    """
+    handler_class = ReportRequestHandler
+    if get_page is not None:
+        handler_class = type(
+            "PageRequestHandler", (ReportRequestHandler,), {"get_page": staticmethod(get_page)}
+        )
+    handler = partial(handler_class, directory=str(directory))
+    with http.server.ThreadingHTTPServer(("", port), handler) as httpd:
+        logger.info(f"Serving at http://localhost:{port}/")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
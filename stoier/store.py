@@ -0,0 +1,79 @@
+"""
+Date partitioned storage of dated dicts (bookings grouped by "%Y-%m-%d" keys).
+
+A store is a directory "<isoformat>.parts" with one file per month or year and an index,
+which lists the partitions sorted by date together with their first and last day. Range
+reads only load the partitions which overlap the range.
+"""
+
+import bisect
+import logging
+
+from datetime import datetime
+from stoier import serialize
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = ".parts"
+INDEX_NAME = "index.yml"
+DATE_FORMAT = "%Y-%m-%d"
+PARTITIONS = {
+    "month": "%Y-%m",
+    "year": "%Y"
+}
+
+
+def save_partitioned(obj, outdirname, fmt="yaml", partition="month"):
+    partition_format = PARTITIONS[partition]
+    partitions = dict()
+    for date_str in sorted(obj.keys()):
+        name = datetime.strptime(date_str, DATE_FORMAT).strftime(partition_format)
+        partitions.setdefault(name, dict())[date_str] = obj[date_str]
+
+    outdirname.mkdir()
+    index = []
+    for name, partition_obj in partitions.items():
+        filename = f"{name}{serialize.FORMATS[fmt]}"
+        serialize.dump_file(partition_obj, outdirname / filename)
+        index.append({
+            "file": filename,
+            "first": min(partition_obj.keys()),
+            "last": max(partition_obj.keys()),
+            "days": len(partition_obj)
+        })
+    serialize.dump_file(index, outdirname / INDEX_NAME)
+    logger.info(f"Written {len(obj)} items in {len(index)} partitions to {outdirname}")
+
+
+def load_partitioned(dirpath, start=None, end=None):
+    """
+    Returns the dated dict stored in dirpath. If start and/or end (datetime, inclusive) are
+    given, only the partitions overlapping the range are read and only days in the range
+    are returned.
+    """
+    index = serialize.load_file(dirpath / INDEX_NAME)
+    start_str = start.strftime(DATE_FORMAT) if start else None
+    end_str = end.strftime(DATE_FORMAT) if end else None
+
+    # Partitions do not overlap, so their last days are sorted as well.
+    first_part = bisect.bisect_left([p["last"] for p in index], start_str) if start_str else 0
+    obj = dict()
+    for partition in index[first_part:]:
+        if end_str and partition["first"] > end_str:
+            break
+        logger.debug(f"Reading partition {partition['file']}")
+        obj.update(serialize.load_file(dirpath / partition["file"]))
+    return filter_dated(obj, start, end)
+
+
+def filter_dated(obj, start=None, end=None):
+    """Returns the days of obj between start and end (datetime, inclusive)."""
+    if not start and not end:
+        return obj
+    start_str = start.strftime(DATE_FORMAT) if start else None
+    end_str = end.strftime(DATE_FORMAT) if end else None
+    return {
+        date_str: entries
+        for date_str, entries in obj.items()
+        if (not start_str or date_str >= start_str) and (not end_str or date_str <= end_str)
+    }
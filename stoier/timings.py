@@ -0,0 +1,116 @@
+"""
+Timing and profiling of the stages.
+
+The commands are decorated with timed, which adds the options --timings PATH and --profile
+PATH. The stages mark their phases (load, transform, save) with `with phase("load"):`.
+For each phase and the whole run the wall time, the cpu time and the peak memory (max RSS
+of the process up to the end of the phase) are recorded and written as JSON to the timings
+file. The profile file contains cProfile stats, which can be read with pstats.
+
+Work done in worker processes (-j) is part of the wall time, but not of the cpu time and
+the memory of the phases.
+"""
+
+import click
+import cProfile
+import functools
+import json
+import logging
+import resource
+import sys
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def get_max_rss_mib():
+    """Returns the peak memory of this process in MiB (ru_maxrss is in KiB on Linux)."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class Timings:
+
+    def __init__(self):
+        self.phases = list()
+        self.started = None
+
+    @contextmanager
+    def measure(self, name, phases=None):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            result = {
+                "phase": name,
+                "wall": round(time.perf_counter() - wall, 3),
+                "cpu": round(time.process_time() - cpu, 3),
+                "max_rss_mib": get_max_rss_mib()
+            }
+            logger.debug(f"Phase {name}: {result}")
+            if phases is not None:
+                phases.append(result)
+
+    def phase(self, name):
+        return self.measure(name, self.phases)
+
+    def save(self, filepath, command, total):
+        with open(filepath, "w") as outfile:
+            json.dump({
+                "command": command,
+                "argv": sys.argv[1:],
+                "started": self.started.isoformat(),
+                "total": total,
+                "phases": self.phases
+            }, outfile, indent=2)
+        logger.info(f"Written timings to {filepath}")
+
+    @contextmanager
+    def run(self, command, timings_path=None):
+        self.phases = list()
+        self.started = datetime.now()
+        total = list()
+        try:
+            with self.measure(command, total):
+                yield
+        finally:
+            if timings_path:
+                self.save(timings_path, command, total[0])
+
+
+TIMINGS = Timings()
+
+
+def phase(name):
+    """Context manager which records a phase of the current run."""
+    return TIMINGS.phase(name)
+
+
+def timed(fct):
+    """Adds --timings and --profile to a click command. Use it below @click.command()."""
+
+    @click.option(
+        "--timings", "timings_path", type=Path, default=None,
+        help="Write wall time, cpu time and peak memory of each phase as JSON to this file"
+    )
+    @click.option(
+        "--profile", "profile_path", type=Path, default=None,
+        help="Write cProfile stats (see pstats) to this file"
+    )
+    @functools.wraps(fct)
+    def wrapper(*args, timings_path, profile_path, **kwargs):
+        with TIMINGS.run(fct.__name__, timings_path):
+            if not profile_path:
+                return fct(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(fct, *args, **kwargs)
+            finally:
+                profile.dump_stats(profile_path)
+                logger.info(f"Written profile to {profile_path}")
+
+    return wrapper
@@ -1,20 +1,282 @@
+import json
 import logging
-import yaml
+import os
+import tempfile
 
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from jinja2 import Template
+from functools import lru_cache
+from jinja2 import Environment, FileSystemLoader
 from pathlib import Path
+from stoier import columnar, serialize, store
 
 logger = logging.getLogger(__name__)
 
+DATA_SUFFIXES = (*serialize.KNOWN_SUFFIXES, store.SUFFIX)
+LATEST_NAME = "latest.json"
 
-def save_yaml(obj, out_path, prefix="", date=None):
+
+def is_latest_fresh(dirpath):
+    """
+    Returns True if the latest manifest of dirpath is up to date, i.e. nothing has been
+    added to dirpath since it has been written.
+    """
+    try:
+        return (dirpath / LATEST_NAME).stat().st_mtime_ns >= dirpath.stat().st_mtime_ns
+    except OSError:
+        return False
+
+
+def set_latest(dirpath, prefix, path, date, fresh=True):
+    """
+    Records path (written at date) as latest file with prefix in the manifest of dirpath.
+
+    The manifest maps each prefix to the name and the date of the latest file. It is
+    replaced atomically and its mtime is set after the replace, so it is newer than the
+    directory until something else is added. If the manifest was not fresh before path
+    was written (see is_latest_fresh), the other prefixes are dropped.
+    """
+    manifest_path = dirpath / LATEST_NAME
+    manifest = dict()
+    if fresh:
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            pass
+    entry = manifest.get(prefix)
+    if entry and datetime.fromisoformat(entry["date"]) > date:
+        return
+    manifest[prefix] = {"name": Path(path).name, "date": date.isoformat()}
+    tmp_path = dirpath / f".{LATEST_NAME}.tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, manifest_path)
+    os.utime(manifest_path)
+
+
+@contextmanager
+def keep_latest_fresh(dirpath):
+    """
+    Keeps the manifest of dirpath fresh while files, which are not recorded in it (e.g.
+    caches), are added to dirpath.
+    """
+    fresh = is_latest_fresh(dirpath)
+    yield
+    if fresh:
+        os.utime(dirpath / LATEST_NAME)
+
+
+def get_latest_from_manifest(dirpath, glob_str="*", suffixes=None):
+    """
+    Returns the latest file matching glob_str ("<prefix>*") recorded in the manifest of
+    dirpath, or None if there is no fresh manifest or no matching entry.
+    """
+    prefix = glob_str[:-1]
+    if not glob_str.endswith("*") or any(c in prefix for c in "*?["):
+        return None
+    if not is_latest_fresh(dirpath):
+        return None
+    try:
+        with open(dirpath / LATEST_NAME) as manifest_file:
+            entry = json.load(manifest_file).get(prefix)
+    except (OSError, ValueError):
+        return None
+    if entry is None:
+        return None
+    latest = dirpath / entry["name"]
+    if suffixes is not None and serialize.get_suffix(latest) not in suffixes:
+        return None
+    if not latest.exists():
+        return None
+    return latest
+
+
+def make_dated_dir(parent_path, date):
+    """
+    Creates the directory parent_path/<date>. It is not recorded as latest until it is
+    complete (see set_latest_dir), so readers of the manifest keep using the previous one.
+    """
+    if not parent_path.is_dir():
+        parent_path.mkdir(parents=True)
+    out_path = parent_path / date.isoformat()
+    with keep_latest_fresh(parent_path):
+        if not out_path.is_dir():
+            out_path.mkdir()
+    return out_path
+
+
+def set_latest_dir(dir_path, date):
+    """Records the complete directory dir_path (see make_dated_dir) as latest in its parent."""
+    set_latest(dir_path.parent, "", dir_path, date, is_latest_fresh(dir_path.parent))
+
+
+def get_outfilename(out_path, prefix="", date=None, fmt="yaml"):
     if not date:
         date = datetime.now()
-    outfilename = out_path / f"{prefix}{date.isoformat()}.yml"
-    with open(outfilename, "w") as outfile:
-        yaml.dump(obj, outfile)
+    return out_path / f"{prefix}{date.isoformat()}{serialize.FORMATS[fmt]}"
+
+
+def save_yaml(obj, out_path, prefix="", date=None, fmt="yaml", latest=True):
+    """
+    Writes obj to a timestamped file in out_path and returns its path. fmt is one of
+    serialize.FORMATS, the suffix of the file marks the format. If latest is set, the file
+    is recorded as latest file with prefix (see set_latest).
+    """
+    if not date:
+        date = datetime.now()
+    fresh = latest and is_latest_fresh(out_path)
+    outfilename = get_outfilename(out_path, prefix, date, fmt)
+    serialize.dump_file(obj, outfilename)
+    if latest:
+        set_latest(out_path, prefix, outfilename, date, fresh)
     logger.info(f"Written {len(obj)} items to file {outfilename}")
+    return outfilename
+
+
+def save_documents(docs, out_path, prefix="", date=None, fmt="yaml", latest=True):
+    """Like save_yaml, but writes several documents (e.g. a header and the data)."""
+    if not date:
+        date = datetime.now()
+    fresh = latest and is_latest_fresh(out_path)
+    outfilename = get_outfilename(out_path, prefix, date, fmt)
+    serialize.dump_all_file(docs, outfilename)
+    if latest:
+        set_latest(out_path, prefix, outfilename, date, fresh)
+    logger.info(f"Written {len(docs)} documents to file {outfilename}")
+
+
+class YamlListWriter:
+    """
+    Incrementally writes a yaml list to a timestamped file, one item at a time.
+
+    The result is the same as calling save_yaml with the complete list, but items are
+    serialized as soon as they are written. If reverse is set, the serialized items are
+    spooled to a temporary file and copied to the output file in reverse order on close,
+    so only their offsets are kept in memory.
+
+    The items are written to a hidden temporary file, which is renamed to the output file
+    on close. If the block raises an exception, the temporary file is removed and nothing
+    is recorded as latest file.
+    """
+
+    def __init__(self, out_path, prefix="", date=None, reverse=False, fmt="yaml"):
+        if not date:
+            date = datetime.now()
+        self.out_path = out_path
+        self.prefix = prefix
+        self.date = date
+        self.outfilename = get_outfilename(out_path, prefix, date, fmt)
+        # Keeps the suffix, so compressed formats are compressed
+        self.tmp_filename = out_path / f".tmp_{self.outfilename.name}"
+        self.reverse = reverse
+        self.n_items = 0
+        self.outfile = None
+        self.spool = None
+        self.offsets = array("Q")
+
+    def __enter__(self):
+        self.fresh = is_latest_fresh(self.out_path)
+        self.outfile = serialize.open_file(self.tmp_filename, "w")
+        if self.reverse:
+            self.spool = tempfile.TemporaryFile()
+        return self
+
+    def write(self, item):
+        chunk = serialize.dump([item])
+        if self.reverse:
+            self.offsets.append(self.spool.tell())
+            self.spool.write(chunk.encode())
+        else:
+            self.outfile.write(chunk)
+        self.n_items += 1
+
+    def close(self):
+        if self.reverse:
+            self.offsets.append(self.spool.tell())
+            for i in range(len(self.offsets) - 2, -1, -1):
+                self.spool.seek(self.offsets[i])
+                chunk = self.spool.read(self.offsets[i + 1] - self.offsets[i])
+                self.outfile.write(chunk.decode())
+            self.spool.close()
+        if not self.n_items:
+            self.outfile.write(serialize.dump([]))
+        self.outfile.close()
+        os.replace(self.tmp_filename, self.outfilename)
+        set_latest(self.out_path, self.prefix, self.outfilename, self.date, self.fresh)
+        logger.info(f"Written {self.n_items} items to file {self.outfilename}")
+
+    def abort(self):
+        """Removes the incomplete output."""
+        if self.spool is not None:
+            self.spool.close()
+        self.outfile.close()
+        self.tmp_filename.unlink(missing_ok=True)
+        logger.info(f"Not writing {self.outfilename} because of an error")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def save_dated(obj, out_path, prefix="", date=None, fmt="yaml", partition=None):
+    """
+    Writes a dated dict and returns its path. If partition is given ("month" or "year"),
+    it is written as a partitioned store (see stoier.store) instead of a single file.
+    """
+    if partition is None:
+        return save_yaml(obj, out_path, prefix=prefix, date=date, fmt=fmt)
+    if not date:
+        date = datetime.now()
+    fresh = is_latest_fresh(out_path)
+    outdirname = out_path / f"{prefix}{date.isoformat()}{store.SUFFIX}"
+    store.save_partitioned(obj, outdirname, fmt, partition)
+    set_latest(out_path, prefix, outdirname, date, fresh)
+    return outdirname
+
+
+def load_dated(filepath, start=None, end=None, columns=None):
+    """
+    Loads a dated dict from a file or a partitioned store. If start and/or end are given,
+    only the days in this range are returned.
+
+    If the file has a valid columnar cache (see stoier.columnar), it is read from the
+    cache instead. In that case the entries only contain the given columns (default: all),
+    otherwise columns is ignored.
+    """
+    if filepath.suffix == store.SUFFIX:
+        return store.load_partitioned(filepath, start, end)
+    obj = columnar.load_columns(filepath, columns, start, end)
+    if obj is not None:
+        return obj
+    return store.filter_dated(serialize.load_file(filepath), start, end)
+
+
+def map_jobs(fct, *iterables, jobs=1):
+    """
+    Works like map, but distributes the calls to a pool of worker processes if jobs > 1.
+
+    The results are yielded in the order of the arguments. fct and all arguments have to
+    be picklable. Unlike ProcessPoolExecutor.map, at most 2 * jobs calls are submitted
+    ahead of the yielded result, so lazily generated arguments are not all kept in memory.
+    """
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = deque()
+            for args in zip(*iterables):
+                futures.append(executor.submit(fct, *args))
+                if len(futures) >= 2 * jobs:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+    else:
+        yield from map(fct, *iterables)
 
 
 def get_date(date_str, date_format):
@@ -33,7 +295,7 @@ class NotADirError(Exception):
 
 
 def get_latest_file(
-        filepath, glob_str="*.yml", ext=".yml", date_extract_fct=lambda f: f.stem
+        filepath, glob_str="*", suffixes=DATA_SUFFIXES, date_extract_fct=serialize.get_stem
 ):
     """
     Given the input from (supposedly) a commandline argument this function returns
@@ -43,61 +305,85 @@ def get_latest_file(
 
     If a filename is given, the filename is returned.
 
-    This also works for directories. In that case, ext should be "".
+    This also works for directories. In that case, suffixes should be None.
 
     :param filename: str/path of the dir or file
-    :param glob_str: glob to be used to identify valid files. Default: *.yml
+    :param glob_str: glob to be used to identify valid files. Default: *
+    :param suffixes: only files with one of these suffixes are considered. Default: all
+                     formats known to stoier.serialize (incl. compressed files) and
+                     partitioned stores
     :param date_extract_fct: callable, which is given the filename, which shall return
                              a datetime object.
     """
     if not isinstance(filepath, Path):
         filepath = Path(filepath)
-    if filepath.is_file():
+    if filepath.is_file() or filepath.suffix == store.SUFFIX:
         return filepath
     else:
         if not filepath.exists():
             raise NotADirError(f"Directory {filepath} does not exist.")
+        latest = get_latest_from_manifest(filepath, glob_str, suffixes)
+        if latest is not None:
+            logger.debug(f"Using {latest} from {LATEST_NAME}")
+            return latest
         logger.debug(f"Finding latest file in {filepath}")
         maxdate = None
+        latest = None
         for fileindir in filepath.glob(glob_str):
+            if suffixes is not None and serialize.get_suffix(fileindir) not in suffixes:
+                continue
             logger.debug(f"Checking {fileindir}")
             try:
                 filedate = datetime.fromisoformat(date_extract_fct(fileindir))
             except Exception:
                 continue
-            if not maxdate:
-                maxdate = filedate
-                continue
-            if filedate > maxdate:
+            if not maxdate or filedate > maxdate:
                 maxdate = filedate
+                latest = fileindir
                 logger.debug(f"Setting {fileindir} as latest file.")
         if not isinstance(maxdate, datetime):
             raise NotADateError("No valid file/dir found")
-        return filepath / f"{maxdate.isoformat()}{ext}"
+        return latest
 
 
-def iterate_dated_dict(obj, *, date_format="%Y-%m-%d", start=None):
-    dates = [datetime.strptime(date, date_format) for date in obj.keys()]
-    dates.sort()
-    if start:
-        if start in dates:
-            start_index = dates.index(start)
-        else:
-            for start_index, date in enumerate(dates):
-                if date > start:
-                    break
-    else:
-        start_index = 0
-    for date in dates[start_index:]:
-        date_str = date.strftime(date_format)
+@lru_cache(maxsize=8)
+def get_date_index(keys, date_format):
+    """
+    Returns the dates of keys (a tuple of date strings) sorted, together with the
+    corresponding keys. The result is cached, so datasets with the same days (e.g. the
+    bookings and their assignments) are only parsed once.
+    """
+    dated_keys = sorted((datetime.strptime(key, date_format), key) for key in keys)
+    return [date for date, key in dated_keys], [key for date, key in dated_keys]
+
+
+def iterate_dated_dict(obj, *, date_format="%Y-%m-%d", start=None, end=None):
+    """
+    Yields (date_str, index, entry) for all entries of a dated dict in date order,
+    optionally only for days between start and end (datetime, inclusive).
+    """
+    dates, keys = get_date_index(tuple(obj.keys()), date_format)
+    start_index = bisect_left(dates, start) if start else 0
+    end_index = bisect_right(dates, end) if end else len(dates)
+    for date_str in keys[start_index:end_index]:
         date_entries = obj[date_str]
         for e, entry in enumerate(date_entries):
             yield date_str, e, entry
 
 
+@lru_cache(maxsize=None)
+def get_environment(templates_path):
+    """Returns a jinja environment for templates_path, which caches compiled templates."""
+    return Environment(loader=FileSystemLoader(templates_path))
+
+
+def render_template(context, template_filepath):
+    template_filepath = Path(template_filepath)
+    template = get_environment(template_filepath.parent).get_template(template_filepath.name)
+    return template.render(**context)
+
+
 def render_html(context, template_filepath, out_filepath):
-    with open(template_filepath) as infile:
-        template = Template(infile.read())
-    html = template.render(**context)
+    html = render_template(context, template_filepath)
     with open(out_filepath, "w") as outfile:
         outfile.write(html)
@@ -2,12 +2,14 @@
 
 import click
 import logging
-import yaml
 
 from collections import defaultdict
 from pathlib import Path
+from stoier import serialize
 from stoier.log import setup_logging
-from stoier.utils import get_latest_file, iterate_dated_dict, save_yaml
+from stoier.store import PARTITIONS
+from stoier.timings import phase, timed
+from stoier.utils import get_latest_file, iterate_dated_dict, load_dated, save_dated
 
 logger = logging.getLogger(__name__)
 
@@ -21,8 +23,12 @@ class ValidatedBook():
     def add_entries_from_yaml(
             self, data_file, amount_col, balance_col, sender_col, net_account_name
     ):
+        self.add_entries(
+            serialize.load(data_file), amount_col, balance_col, sender_col, net_account_name
+        )
+
+    def add_entries(self, data, amount_col, balance_col, sender_col, net_account_name):
         old_balance = None
-        data = yaml.load(data_file, Loader=yaml.Loader)
         for date_str, e, entry in iterate_dated_dict(data):
             if self.accounts:
                 gross_account = self.accounts.get(entry[sender_col], None)
@@ -46,11 +52,12 @@ class ValidatedBook():
                     logger.error(f"{new_balance} != {old_balance} + {entry[amount_col]}")
                 old_balance = new_balance
 
-    def to_file(self, out_path):
-        save_yaml(dict(self.entries), out_path)
+    def to_file(self, out_path, fmt="yaml", partition=None):
+        save_dated(dict(self.entries), out_path, fmt=fmt, partition=partition)
 
 
 @click.command()
+@timed
 @click.option("-d", "--debug", is_flag=True, default=False)
 @click.option("-v", "--verbose", is_flag=True, default=False)
 @click.option("-a", "--amount_col", "amount_col", default="amount")
@@ -58,6 +65,13 @@ class ValidatedBook():
 @click.option("-s", "--sender_col", "sender_col", default="sender")
 @click.option("-n", "--net_account_name", "net_account_name", default="earnings")
 @click.option("--accounts", "acct_filename", default=None)
+@click.option(
+    "--output-format", "fmt", type=click.Choice(serialize.FORMATS.keys()), default="yaml"
+)
+@click.option(
+    "--partition", type=click.Choice(PARTITIONS.keys()), default=None,
+    help="Write a store partitioned by month or year instead of a single file"
+)
 @click.argument("out_dir")
 @click.argument("filename")
 def validate(
@@ -69,6 +83,8 @@ def validate(
     net_account_name,
     out_dir,
     acct_filename,
+    fmt,
+    partition,
     filename
 ):
     setup_logging(debug, verbose)
@@ -79,26 +95,30 @@ def validate(
     if acct_filename:
         acct_filepath = get_latest_file(
             acct_filename,
-            glob_str="accounts_*.yml",
-            date_extract_fct=lambda f: f.stem[9:]
+            glob_str="accounts_*",
+            date_extract_fct=lambda f: serialize.get_stem(f)[9:]
         )
         logger.debug(f"Using {acct_filepath} as accounts file.")
-        with open(acct_filepath) as acct_file:
-            accounts = yaml.safe_load(acct_file)
+        with serialize.open_file(acct_filepath) as acct_file:
+            accounts = serialize.safe_load(acct_file)
     else:
         accounts = None
 
     v_book = ValidatedBook(accounts)
 
-    with open(data_filepath) as data_file:
-        v_book.add_entries_from_yaml(
-            data_file, amount_col, balance_col, sender_col, net_account_name
+    with phase("load"):
+        # Only these columns are read from the columnar cache (without details etc.)
+        data = load_dated(
+            data_filepath, columns=("id", amount_col, balance_col, sender_col)
         )
+    with phase("transform"):
+        v_book.add_entries(data, amount_col, balance_col, sender_col, net_account_name)
 
     out_path = Path(out_dir) / "04_valid_bookings"
     if not out_path.is_dir():
         out_path.mkdir(parents=True)
-    v_book.to_file(out_path)
+    with phase("save"):
+        v_book.to_file(out_path, fmt, partition)
 
 
 if __name__ == "__main__":